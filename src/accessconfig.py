@@ -0,0 +1,213 @@
+# accessconfig.py -- Keys and access control that are reloaded while running
+#
+# The keys in keyconfig and the ACLs, rates and weights in commandaccess are
+# Python modules, which are only read when a server starts.  To change them
+# without a restart, they may instead be written to two JSON files:
+#
+#  * keys.json holds a list of JWKs, each with a kid, as given to newkey()
+#    in keyconfig
+#  * access.json holds a dictionary with acls, rates and weights, each in
+#    the form of the variable with that name in commandaccess
+#
+# Each of these files is used when it exists, and the module is used when
+# it does not.  The configuration is read into a Snapshot, with the ACLs
+# compiled into one set of welcome kids per command.  It is first loaded
+# by start(), which servers call to refuse to run with an unusable file,
+# or else on the first use of current().  After that, the files are checked
+# for changes every check_interval seconds, and immediately after a SIGHUP;
+# a changed file is read into a new Snapshot that replaces the old one.
+# Files that fail to load are logged and the old Snapshot remains in use.
+#
+# A request takes the current Snapshot when it arrives, and uses that for
+# all its checks, so requests that are in progress are not affected by a
+# change, and nothing else needs to be restarted or emptied.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import time
+import signal
+import syslog
+import threading
+
+import json
+
+import keyconfig
+import commandaccess
+
+
+# The directory with the configuration files, which can be set with
+# ODSRPC_CONFDIR
+confdir = os.environ.get ('ODSRPC_CONFDIR', '/etc/opendnssec/rpc')
+
+keys_file   = confdir + os.sep + 'keys.json'
+access_file = confdir + os.sep + 'access.json'
+
+# The number of seconds between checks for changed files
+check_interval = 5
+
+
+#
+# An immutable configuration; do not modify its dictionaries
+#
+class Snapshot:
+
+	def __init__ (self, keys, acls, rates, weights):
+		self.keys = dict (keys)
+		self.rates = dict (rates)
+		self.weights = dict (weights)
+		self.wildcard = frozenset (acls.get ('*', [ ]))
+		self.welcome = dict ([ (command, self.wildcard | frozenset (kids))
+				for (command,kids) in acls.items () ])
+
+	# Whether the ACLs let a kid invoke a command
+	def allowed (self, command, kid):
+		return kid in self.welcome.get (command, self.wildcard)
+
+
+#
+# JSON produces unicode strings, where the modules have str
+#
+def plain (value):
+	if type (value) == unicode:
+		return str (value)
+	if type (value) == list:
+		return [ plain (elem) for elem in value ]
+	if type (value) == dict:
+		return dict ([ (plain (key), plain (elem))
+				for (key,elem) in value.items () ])
+	return value
+
+def load_json (path):
+	fh = open (path)
+	try:
+		return plain (json.load (fh))
+	finally:
+		fh.close ()
+
+# Whether a value from JSON is a number above zero
+def positive (value):
+	return type (value) in [ int, long, float ] and value > 0
+
+#
+# Load a Snapshot from the files, or from the modules where there is no
+# file; raise IOError or ValueError if a file is unusable
+#
+def load ():
+	if os.path.exists (keys_file):
+		keys = { }
+		for key in load_json (keys_file):
+			if type (key) != dict or not key.has_key ('kid'):
+				raise ValueError ('Key without kid in ' + keys_file)
+			keys [key ['kid']] = key
+	else:
+		keys = keyconfig.keys
+	if os.path.exists (access_file):
+		access = load_json (access_file)
+		if type (access) != dict:
+			raise ValueError ('No dictionary in ' + access_file)
+		acls    = access.get ('acls',    { })
+		rates   = access.get ('rates',   { })
+		weights = access.get ('weights', { })
+		if type (acls) != dict or type (rates) != dict or type (weights) != dict:
+			raise ValueError ('The acls, rates and weights are not dictionaries in ' + access_file)
+		for (kid,rate) in rates.items ():
+			if type (rate) != list or len (rate) != 2 or not positive (rate [0]) or not positive (rate [1]):
+				raise ValueError ('Rate for ' + kid + ' is not [rate,burst] in ' + access_file)
+			rates [kid] = tuple (rate)
+	else:
+		acls    = commandaccess.acls
+		rates   = commandaccess.rates
+		weights = commandaccess.weights
+	for (command,kids) in acls.items ():
+		if type (kids) not in [ list, tuple ] or [ kid for kid in kids if type (kid) != str ] != [ ]:
+			raise ValueError ('ACL for ' + command + ' is not a list of kid strings')
+	for (kid,weight) in weights.items ():
+		if not positive (weight):
+			raise ValueError ('Weight for ' + kid + ' is not a positive number')
+	return Snapshot (keys, acls, rates, weights)
+
+#
+# The modification stamps of the files, to notice changes
+#
+def stamp (path):
+	try:
+		st = os.stat (path)
+		return (st.st_ino, st.st_size, st.st_mtime)
+	except OSError:
+		return None
+
+def stamps ():
+	return (stamp (keys_file), stamp (access_file))
+
+
+snapshot = None
+loaded = None
+checked = 0
+hangup = False
+lock = threading.Lock ()
+
+#
+# Replace the Snapshot if the files changed, or after a SIGHUP.  Only one
+# thread reloads; the others continue with the current Snapshot.
+#
+def refresh ():
+	global snapshot, loaded, checked, hangup
+	if not lock.acquire (False):
+		return
+	try:
+		forced = hangup
+		hangup = False
+		checked = time.time ()
+		current = stamps ()
+		if current == loaded and not forced:
+			return
+		try:
+			fresh = load ()
+		except (IOError, ValueError), e:
+			syslog.syslog (syslog.LOG_ERR, 'Keeping the old access configuration: ' + str (e))
+			return
+		snapshot = fresh
+		loaded = current
+		syslog.syslog (syslog.LOG_INFO, 'Loaded the access configuration from ' + confdir)
+	finally:
+		lock.release ()
+
+#
+# Load the first Snapshot, unless that was done already; raise IOError or
+# ValueError if a file is unusable
+#
+def start ():
+	global snapshot, loaded, checked
+	lock.acquire ()
+	try:
+		if snapshot is not None:
+			return
+		current = stamps ()
+		snapshot = load ()
+		loaded = current
+		checked = time.time ()
+		syslog.syslog (syslog.LOG_INFO, 'Loaded the access configuration from ' + confdir)
+	finally:
+		lock.release ()
+
+#
+# Return the current Snapshot, to be used for all of one request
+#
+def current ():
+	if snapshot is None:
+		start ()
+	elif hangup or time.time () >= checked + check_interval:
+		refresh ()
+	return snapshot
+
+def on_sighup (signum, frame):
+	global hangup
+	hangup = True
+
+#
+# Reload after SIGHUP; call this from the main thread of a server
+#
+def watch_sighup ():
+	signal.signal (signal.SIGHUP, on_sighup)
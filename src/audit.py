@@ -0,0 +1,169 @@
+# audit.py -- Reconcile the flag registry with the backend and DNS
+#
+# Drift between the flags, the zones under keyed management in the backend
+# and what DNS shows would otherwise only surface when a command sets the
+# invalid flag.  The auditor takes one list of zones from the backend and
+# one scan of the flag store, and compares them without querying anything
+# else.  Only the zones that disagree are checked in DNS, concurrently and
+# within a query budget.
+#
+# The DNS checks proceed in sorted order of the zones, and the last zone
+# whose report was taken by the caller is stored in a cursor file.  An
+# audit that is stopped halfway resumes after that zone, so the zone that
+# was being reported may be reported again.  The cursor is removed when
+# the audit is done.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import dnslogic
+import cdsscan
+import backend
+import genericapi
+
+from ratelimit import TokenBucket
+
+
+# The file that holds the cursor of an unfinished audit
+cursor_file = genericapi.flagdir + '.audit'
+
+# The number of zones checked in DNS concurrently
+workers = 8
+
+# The budget of zone checks per second, and the burst size
+budget = (10, 50)
+
+# The lifecycle states in which the backend manages a zone
+managed_states = [ 'signing', 'signed', 'chaining', 'chained',
+		'unchaining', 'unchained' ]
+
+# The lifecycle states in which DS records are expected in the parent,
+# and those in which they are not
+ds_states = [ 'chained' ]
+no_ds_states = [ 'signing', 'signed', 'unchained', 'unsigning', 'unsigned' ]
+
+#
+# The discrepancies that are reported
+#
+ISSUE_UNMANAGED  = 'unmanaged'		# Flags say managed, backend does not
+ISSUE_UNFLAGGED  = 'unflagged'		# Backend manages, flags say not
+ISSUE_DS_MISSING = 'ds-missing'		# Chained, but the CDS scan found no DS
+ISSUE_DS_PRESENT = 'ds-present'		# Not chained, but the CDS scan found DS
+ISSUE_INVALID    = 'invalid'		# The invalid flag is set
+
+
+#
+# Compare the backend with the flags, and return a sorted list of
+# (zone,state,managed,issues) for the zones that disagree
+#
+def compare (managed, now=None):
+	if now is None:
+		now = time.time ()
+	managed = set (managed)
+	retval = [ ]
+	for (zone,flags) in genericapi.scan_flags ():
+		state = genericapi.zone_state (flags, now)
+		inbackend = zone in managed
+		managed.discard (zone)
+		issues = [ ]
+		if state == 'invalid':
+			issues.append (ISSUE_INVALID)
+		elif inbackend and not state in managed_states:
+			issues.append (ISSUE_UNFLAGGED)
+		elif state in managed_states and not inbackend:
+			issues.append (ISSUE_UNMANAGED)
+		present = None
+		if flags.has_key ('cds'):
+			present = cdsscan.ds_present (flags ['cds'],
+					genericapi.cds_scantime (zone), now)
+		if present is False and state in ds_states:
+			issues.append (ISSUE_DS_MISSING)
+		if present is True and state in no_ds_states:
+			issues.append (ISSUE_DS_PRESENT)
+		if len (issues) > 0:
+			retval.append ( (zone, state, inbackend, issues) )
+	# Zones in the backend without any flags
+	for zone in managed:
+		retval.append ( (zone, 'unsigned', True, [ ISSUE_UNFLAGGED ]) )
+	retval.sort ()
+	return retval
+
+
+#
+# Check a zone in DNS, and return a report entry for it
+#
+def check (discrepancy):
+	(zone,state,inbackend,issues) = discrepancy
+	entry = {
+		'zone':    zone,
+		'state':   state,
+		'backend': inbackend,
+		'issues':  issues,
+	}
+	try:
+		entry ['dnskey'] = dnslogic.test_for_signed_dnskey (zone,
+				dnslogic.PUBLISHER_AUTHORITATIVES |
+				dnslogic.PUBLISHER_SOME)
+	except Exception:
+		entry ['dnskey'] = None
+	try:
+		entry ['ds'] = dnslogic.have_ds (zone)
+	except Exception:
+		entry ['ds'] = None
+	return entry
+
+
+def read_cursor ():
+	try:
+		return open (cursor_file).read ().strip () or None
+	except IOError:
+		return None
+
+def write_cursor (zone):
+	fh = open (cursor_file + '.tmp', 'w')
+	fh.write (zone + '\n')
+	fh.close ()
+	os.rename (cursor_file + '.tmp', cursor_file)
+
+def clear_cursor ():
+	try:
+		os.unlink (cursor_file)
+	except OSError:
+		pass
+
+
+#
+# Run an audit and produce report entries for the zones that disagree,
+# resuming after the cursor of an unfinished audit.  Raise IOError when the
+# backend cannot list its zones.
+#
+def audit ():
+	managed = backend.list_zones ()
+	if managed is None:
+		raise IOError ('Failed to list the zones in the backend')
+	todo = compare (managed)
+	cursor = read_cursor ()
+	if cursor is not None:
+		todo = [ discrepancy for discrepancy in todo if discrepancy [0] > cursor ]
+	bucket = TokenBucket (*budget)
+	def paced (discrepancy):
+		wait = bucket.take (1)
+		while wait > 0:
+			time.sleep (wait)
+			wait = bucket.take (1)
+		return check (discrepancy)
+	pool = ThreadPool (workers)
+	try:
+		# Ordered results, so the cursor only passes reported zones
+		for entry in pool.imap (paced, todo):
+			yield entry
+			write_cursor (entry ['zone'])
+	finally:
+		# Queued checks are not wanted when the caller stopped reading
+		pool.terminate ()
+	clear_cursor ()
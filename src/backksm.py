@@ -9,12 +9,37 @@
 
 
 import os
+import subprocess
+
+import zonefile
 
 
 zone_input_dir = '/var/opendnssec/unsigned'
 zone_output_dir = '/var/named/chroot/var/named/opendnssec'
 
 
+#
+# API routine: the apex of the input zone file, or None if it is unusable
+#
+def input_apex (zone):
+	return zonefile.apex (zone_input_dir + '/' + zone + '.axfr', zone, canonical=False)
+
+#
+# API routine: check the input zone before adding it, return None when it is
+# fine or otherwise a description of what is wrong with it
+#
+def check_zone (zone):
+	apex = input_apex (zone)
+	if apex is None:
+		return 'Missing or unreadable input file for zone ' + zone
+	if not apex.has ('SOA'):
+		return 'No apex SOA record in input file for zone ' + zone
+	if not apex.has ('NS'):
+		return 'No apex NS records in input file for zone ' + zone
+	if apex.negative_caching_ttl () is None:
+		return 'Malformed SOA record in input file for zone ' + zone
+	return None
+
 #
 # API routine: add a zone to keyed management, return zero on success
 #
@@ -29,4 +54,39 @@ def unmanage_zone (zone):
 	cmd = 'ods-ksmutil zone delete --zone "' + zone + '"'
 	return os.system (cmd)
 
+#
+# API routine: list the zones under keyed management, or None on failure
+#
+def list_zones ():
+	try:
+		enforcer = subprocess.Popen (['ods-ksmutil', 'zone', 'list'],
+				stdout=subprocess.PIPE)
+		(output,_) = enforcer.communicate ()
+	except OSError:
+		return None
+	if enforcer.returncode != 0:
+		return None
+	zones = [ ]
+	for line in output.splitlines ():
+		# Found Zone: example.com; on policy default
+		if line.startswith ('Found Zone: '):
+			zone = line [12:].split (';') [0].strip ()
+			zones.append (zone.lower ().rstrip ('.'))
+	return zones
 
+#
+# API routine: have the signer sign zones afresh in one session, return the
+# list of zones that it accepted
+#
+def sign_zones (zones):
+	try:
+		signer = subprocess.Popen (['ods-signer'],
+				stdin=subprocess.PIPE,
+				stdout=subprocess.PIPE,
+				stderr=subprocess.STDOUT)
+		commands = ''.join ([ 'sign ' + zone + '\n' for zone in zones ])
+		(output,_) = signer.communicate (commands + 'exit\n')
+	except OSError:
+		return [ ]
+	return [ zone for zone in zones
+			if 'Zone ' + zone + ' scheduled' in output ]
@@ -0,0 +1,129 @@
+# cdsscan.py -- Compare the CDS records of child zones with DS in the parent
+#
+# Child zones may publish CDS records (RFC 7344) to express the DS records
+# that they desire in their parent.  This module looks up the CDS records
+# at the child's authoritatives and the DS records at the parent's, for
+# many zones at once with concurrent queries, and classifies the outcome.
+# Identical queries from sibling zones, such as the NS records of a shared
+# parent, are coalesced by dnslogic.
+#
+# The ods-cdsscan tool stores the status in the cds flag of each zone, and
+# the time of the scan as the modification time of the flag file.  The flag
+# is only rewritten when the status changes, so a scan that confirms the
+# last one adds no flag events.  While the scan is fresh, genericapi takes
+# the presence of DS records from it, instead of querying all the parent
+# name servers again for each poll of the zone.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from dns import rdatatype
+
+import dnslogic
+
+
+# The number of zones scanned concurrently
+workers = 16
+
+# The number of seconds that a scan outcome may be used by genericapi
+freshness = 600
+
+# The CDS record type, which older dnspython does not know by name
+CDS = 59
+
+# The CDS value that requests removal of the DS records (RFC 8078)
+CDS_DELETE = '\x00\x00\x00\x00\x00'
+
+#
+# The scan outcomes; the DS records are present in all parent name servers
+# for STATUS_MATCH, STATUS_DIFFER and STATUS_DELETE, and absent in all of
+# them for STATUS_ABSENT
+#
+STATUS_MATCH   = 'match'	# DS equals the child's CDS
+STATUS_DIFFER  = 'differ'	# DS differs from the CDS, there is no CDS,
+				# or the children disagree on the CDS
+STATUS_DELETE  = 'delete'	# DS remains while the CDS requests deletion
+STATUS_ABSENT  = 'absent'	# No DS in the parent
+STATUS_PARTIAL = 'partial'	# DS in some parent name servers, not all
+STATUS_UNKNOWN = 'unknown'	# Queries failed
+
+ds_statuses = [ STATUS_MATCH, STATUS_DIFFER, STATUS_DELETE ]
+
+
+#
+# Criterium on Response.Answer: the set of records in the RRset, in a form
+# that is the same for CDS and DS, and empty when there is no RRset
+#
+def digests (ans):
+	if len (ans) == 0:
+		return frozenset ()
+	return frozenset ([ rd.to_digestable () for rd in ans [0] ])
+
+
+#
+# Scan one zone and return its status
+#
+def scan_zone (zone):
+	try:
+		parents = dnslogic.publisher_query (zone, rdatatype.DS,
+				dnslogic.PUBLISHER_PARENTS, digests)
+		if parents is None or None in parents:
+			return STATUS_UNKNOWN
+		withds = [ ds for ds in parents if len (ds) > 0 ]
+		if len (withds) == 0:
+			return STATUS_ABSENT
+		if len (withds) < len (parents):
+			return STATUS_PARTIAL
+		children = dnslogic.publisher_query (zone, CDS,
+				dnslogic.PUBLISHER_AUTHORITATIVES, digests)
+	except Exception, e:
+		print 'CDS SCAN EXCEPTION FOR', zone, ':', e
+		return STATUS_UNKNOWN
+	if children is None or None in children:
+		return STATUS_UNKNOWN
+	for cds in children:
+		if cds != children [0]:
+			# The CDS is only meaningful when all children agree
+			return STATUS_DIFFER
+	if CDS_DELETE in children [0]:
+		return STATUS_DELETE
+	for ds in parents:
+		if ds != children [0]:
+			return STATUS_DIFFER
+	return STATUS_MATCH
+
+
+#
+# Scan many zones concurrently, and produce (zone,status,scantime) tuples
+# as they complete
+#
+def scan_zones (zones):
+	pool = ThreadPool (workers)
+	try:
+		scan = lambda zone: (zone, scan_zone (zone), int (time.time ()))
+		for outcome in pool.imap_unordered (scan, zones):
+			yield outcome
+	finally:
+		pool.close ()
+
+
+#
+# Interpret the status in a cds flag and the time of its scan; return True
+# or False for the presence of DS records in all parent name servers, or
+# None if the scan is not fresh or not conclusive
+#
+def ds_present (status, scantime, now=None):
+	if now is None:
+		now = time.time ()
+	if scantime is None or now - scantime > freshness:
+		return None
+	if status in ds_statuses:
+		return True
+	if status == STATUS_ABSENT:
+		return False
+	return None
+
@@ -12,6 +12,11 @@
 # ACLs.  Mentioning a kid in a command-named ACL only applies access to
 # the command named by the ACL.
 #
+# The rates limit the number of zones per second that a kid may submit, with
+# a burst size in zones; kids that are not mentioned are not limited.  The
+# weights give the relative share of per-zone processing for each kid while
+# requests of several kids are waiting; the default weight is 1.
+#
 # From: Rick van Rein <rick@openfortress.nl>
 
 
@@ -30,4 +35,10 @@ acls ['assert_unchained'] = [ ]
 acls ['sign_ignore'] = [ ]
 acls ['sign_stop'] = [ ]
 acls ['assert_unsigned'] = [ ]
+acls ['status'] = [ ]
+
+rates = { }
+# rates ['portal+key1@example.com'] = (50, 5000)
 
+weights = { }
+weights ['nobody'] = 1
@@ -18,14 +18,21 @@
 # From: Rick van Rein <rick@openfortress.nl>
 
 
+import sys
 import time
 import syslog
+import threading
+import socket
+import struct
 from math import ceil
 
-from localrules import ods_output, local_resolver
+from localrules import ods_output, ods_output_zonefiles, ods_input_soa, local_resolver
+
+import backend
+import zonefile
 
 from dns import name, resolver, query, exception
-from dns import message, rdatatype, rdataclass, rcode
+from dns import message, rdatatype, rdataclass, rcode, flags, inet
 
 #
 # Values that can be used to indicate a desired publisher
@@ -83,24 +90,373 @@ def list_name_servers (zone, publisher):
 	if   publisher == PUBLISHER_OPENDNSSEC:
 		return [ ods_output ]
 	elif publisher == PUBLISHER_AUTHORITATIVES:
-		rss = local_resolver.query (
-				name.from_text (zone),
-				rdtype=rdatatype.NS).rrset
+		rss = resolve (zone, rdatatype.NS).rrset
 		return [ str (rs) for rs in rss ]
 	elif publisher == PUBLISHER_PARENTS:
 		if not '.' in zone:
 			return None
 		(child,parent) = zone.split ('.', 1)
 		try:
-			rrs = local_resolver.query (
-					name.from_text (parent),
-					rdtype=rdatatype.NS).rrset
+			rrs = resolve (parent, rdatatype.NS).rrset
 			return [ str (rs) for rs in rrs ]
 		except resolver.NXDOMAIN:
 			return None
 	else:
 		return None
 
+#
+# Single-flight coalescing of identical queries.  When a query is already
+# outstanding under the same key (server, qname, qtype, DO bit), a thread
+# asking the same waits for its outcome instead of sending another query.
+# The flight is dropped when its query completes; responses from name
+# servers are then kept a while longer in the probe cache, see probe().
+# The local resolver is written as server '' in the key.
+#
+class Flight:
+	def __init__ (self):
+		self.done = threading.Event ()
+		self.result = None
+		self.error = None
+
+flights = { }
+flights_lock = threading.Lock ()
+
+def single_flight (key, fun, *args):
+	flights_lock.acquire ()
+	try:
+		flight = flights.get (key)
+		leader = flight is None
+		if leader:
+			flight = Flight ()
+			flights [key] = flight
+	finally:
+		flights_lock.release ()
+	if not leader:
+		flight.done.wait ()
+		if flight.error is not None:
+			raise flight.error [0], flight.error [1], flight.error [2]
+		return flight.result
+	try:
+		flight.result = fun (*args)
+	except:
+		flight.error = sys.exc_info ()
+		raise
+	finally:
+		flights_lock.acquire ()
+		del flights [key]
+		flights_lock.release ()
+		flight.done.set ()
+	return flight.result
+
+#
+# Query the local resolver, coalescing identical queries
+#
+def resolve (qname, rdtype):
+	return single_flight (('', qname, rdtype, False),
+			lambda: local_resolver.query (
+					name.from_text (qname),
+					rdtype=rdtype))
+
+
+#
+# Find the addresses of a name server; these are assumed to be equivalent,
+# so any one of the addresses may provide an answer.
+#
+def name_server_addresses (ns):
+	nsas = []
+	for rdtype in [rdatatype.AAAA, rdatatype.A]:
+		try:
+			for nsa in resolve (ns, rdtype):
+				nsas.append (str (nsa))
+		except resolver.NXDOMAIN:
+			pass
+	return nsas
+
+#
+# Health tracking for name server addresses, shared across zones and
+# requests.  The round-trip time is estimated as in RFC 6298, and sets the
+# timeout for each address.  Addresses that fail to respond repeatedly
+# are put in a penalty box for a period that doubles with each failure;
+# they are only tried when no other address is left.
+#
+rtt_initial     = 1.0
+rtt_min_timeout = 0.2
+rtt_max_timeout = 5.0
+penalty_failures = 2
+penalty_base     = 30
+penalty_max      = 900
+
+class ServerHealth:
+	def __init__ (self):
+		self.srtt = None
+		self.rttvar = None
+		self.failures = 0
+		self.penalty_until = 0
+
+health = { }
+health_lock = threading.Lock ()
+
+def server_health (nsa):
+	hlt = health.get (nsa)
+	if hlt is None:
+		hlt = ServerHealth ()
+		health [nsa] = hlt
+	return hlt
+
+def rtt_timeout (nsa):
+	health_lock.acquire ()
+	try:
+		hlt = server_health (nsa)
+		if hlt.srtt is None:
+			return rtt_initial
+		rto = hlt.srtt + 4 * hlt.rttvar
+		return max (rtt_min_timeout, min (rtt_max_timeout, rto))
+	finally:
+		health_lock.release ()
+
+def rtt_success (nsa, rtt):
+	health_lock.acquire ()
+	try:
+		hlt = server_health (nsa)
+		if hlt.srtt is None:
+			hlt.srtt = rtt
+			hlt.rttvar = rtt / 2
+		else:
+			hlt.rttvar = 0.75 * hlt.rttvar + 0.25 * abs (hlt.srtt - rtt)
+			hlt.srtt = 0.875 * hlt.srtt + 0.125 * rtt
+		hlt.failures = 0
+		hlt.penalty_until = 0
+	finally:
+		health_lock.release ()
+
+def rtt_failure (nsa):
+	health_lock.acquire ()
+	try:
+		hlt = server_health (nsa)
+		hlt.failures = hlt.failures + 1
+		if hlt.failures >= penalty_failures:
+			penalty = penalty_base * 2 ** (hlt.failures - penalty_failures)
+			hlt.penalty_until = time.time () + min (penalty, penalty_max)
+			syslog.syslog (syslog.LOG_INFO, 'Name server address ' + nsa + ' failed ' + str (hlt.failures) + ' times; penalised until ' + time.ctime (hlt.penalty_until))
+	finally:
+		health_lock.release ()
+
+#
+# Order addresses to prefer the fastest, with unknown addresses at the
+# initial estimate, and leave out penalised addresses unless they are all
+# that is left
+#
+def order_addresses (nsas):
+	now = time.time ()
+	health_lock.acquire ()
+	try:
+		ranked = [ ]
+		for nsa in nsas:
+			hlt = server_health (nsa)
+			if hlt.srtt is None:
+				srtt = rtt_initial
+			else:
+				srtt = hlt.srtt
+			ranked.append ( (hlt.penalty_until > now, srtt, nsa) )
+	finally:
+		health_lock.release ()
+	ranked.sort ()
+	usable = [ nsa for (penalised,srtt,nsa) in ranked if not penalised ]
+	if len (usable) > 0:
+		return usable
+	return [ nsa for (penalised,srtt,nsa) in ranked ]
+
+#
+# TCP fallback for truncated answers, as happens with large DNSKEY RRsets.
+# Connections are kept open after use, per address, so repeated probes of
+# the same server reuse them as permitted by RFC 7766.  A connection is
+# used by one query at a time; a pooled connection that the server closed
+# in the meantime is replaced once by a fresh one.  After truncation, the
+# address is queried over TCP directly for that query type for a while.
+#
+tcp_max_idle  = 4
+tcp_idle_time = 20
+tcp_prefer_time = 3600
+
+tcp_idle = { }
+tcp_prefer = { }
+tcp_lock = threading.Lock ()
+
+def tcp_connection (nsa, timeout):
+	now = time.time ()
+	tcp_lock.acquire ()
+	try:
+		idle = tcp_idle.get (nsa, [ ])
+		while len (idle) > 0:
+			(sox,lastused) = idle.pop ()
+			if now - lastused < tcp_idle_time:
+				return (sox, True)
+			sox.close ()
+	finally:
+		tcp_lock.release ()
+	sox = socket.socket (inet.af_for_address (nsa), socket.SOCK_STREAM)
+	sox.settimeout (timeout)
+	try:
+		sox.connect ((nsa, 53))
+	except:
+		sox.close ()
+		raise
+	return (sox, False)
+
+def tcp_release (nsa, sox):
+	tcp_lock.acquire ()
+	try:
+		idle = tcp_idle.setdefault (nsa, [ ])
+		if len (idle) < tcp_max_idle:
+			idle.append ( (sox, time.time ()) )
+			sox = None
+	finally:
+		tcp_lock.release ()
+	if sox is not None:
+		sox.close ()
+
+def tcp_receive (sox, length):
+	data = ''
+	while len (data) < length:
+		more = sox.recv (length - len (data))
+		if more == '':
+			raise EOFError ('Connection closed by name server')
+		data = data + more
+	return data
+
+def tcp_exchange (request, nsa, timeout):
+	wire = request.to_wire ()
+	for attempt in [1,2]:
+		(sox,reused) = tcp_connection (nsa, timeout)
+		try:
+			sox.settimeout (timeout)
+			sox.sendall (struct.pack ('!H', len (wire)) + wire)
+			while True:
+				(length,) = struct.unpack ('!H', tcp_receive (sox, 2))
+				response = message.from_wire (tcp_receive (sox, length))
+				if request.is_response (response):
+					break
+		except (socket.error, EOFError):
+			sox.close ()
+			if reused and attempt == 1:
+				continue
+			raise
+		except:
+			sox.close ()
+			raise
+		tcp_release (nsa, sox)
+		return response
+
+#
+# Exchange a query with one name server address, over UDP with fallback to
+# TCP when the answer is truncated
+#
+def exchange (request, nsa, rrtype, timeout):
+	key = (nsa, rrtype)
+	if tcp_prefer.get (key, 0) < time.time ():
+		response = query.udp (
+				request,
+				nsa,
+				timeout)
+		if not response.flags & flags.TC:
+			return response
+		tcp_prefer [key] = time.time () + tcp_prefer_time
+	return tcp_exchange (request, nsa, timeout)
+
+#
+# Query one name server through any of its addresses, and return the
+# response, or None if no usable response was received within the
+# lifetime of the local resolver
+#
+def query_name_server (nsas, zone, rrtype):
+	request = message.make_query (
+			name.from_text (zone),
+			rrtype,
+			rdataclass.IN,
+			use_edns=True,
+			# endsflags=0,
+			payload=4096,
+			want_dnssec=True)
+	backoff = 0.10
+	response = None
+	done = False
+	deadline = time.time () + local_resolver.lifetime
+	while (response is None) and (not done):
+		for nsa in order_addresses (nsas):
+			remaining = deadline - time.time ()
+			if remaining <= 0:
+				break
+			timeout = min (rtt_timeout (nsa), remaining)
+			sent = time.time ()
+			try:
+				response = exchange (
+						request,
+						nsa,
+						rrtype,
+						timeout)
+			except:
+				rtt_failure (nsa)
+				response = None
+				continue
+			rtt_success (nsa, time.time () - sent)
+			errcode = response.rcode ()
+			if errcode == rcode.NOERROR:
+				done = True
+				break
+			if errcode == rcode.NXDOMAIN:
+				break
+			response = None
+		remaining = deadline - time.time ()
+		if remaining <= 0:
+			done = True
+			break
+		if response is None:
+			time.sleep (min (remaining, backoff))
+			backoff = backoff * 2
+	return response
+
+#
+# Responses from name servers are kept for a short while, so a check that
+# follows shortly after another, or after the prefetcher, is answered from
+# memory.  They are kept no longer than the TTL in the answer, if any.
+# The key holds the whole query, so the addresses that were asked, the
+# query name, the query type and the DO bit, which query_name_server()
+# always sets; a name server whose addresses changed is asked again.
+#
+probe_lifetime = 60
+probe_prune_size = 10000
+
+probes = { }
+probes_lock = threading.Lock ()
+
+def probe (ns, nsas, zone, rrtype):
+	qname = zone.lower ().rstrip ('.') + '.'
+	key = (tuple (sorted (nsas)), qname, rrtype, True)
+	now = time.time ()
+	probes_lock.acquire ()
+	try:
+		cached = probes.get (key)
+	finally:
+		probes_lock.release ()
+	if cached is not None and cached [0] > now:
+		return cached [1]
+	response = single_flight (key, query_name_server, nsas, zone, rrtype)
+	if response is None:
+		return None
+	lifetime = probe_lifetime
+	for rrset in response.answer:
+		lifetime = min (lifetime, rrset.ttl)
+	probes_lock.acquire ()
+	try:
+		if len (probes) >= probe_prune_size:
+			for (oldkey,(expiry,_)) in probes.items ():
+				if expiry <= now:
+					del probes [oldkey]
+		probes [key] = (now + lifetime, response)
+	finally:
+		probes_lock.release ()
+	return response
+
 #
 # Make a collective query at some source and return the various results
 # The answerproc function processes the individual response.answers
@@ -111,66 +467,9 @@ def collective_query (zone, rrtype, name_servers, answerproc=None):
 	retval = []
 	# For now: Serial query
 	for ns in name_servers:
-		# Within a NS record, alternative address may be available.
-		# We are going to assume that they are equivalent, so any one
-		# of the addresses may provide an answer.
-		res = resolver.Resolver (configure=False)
-		res.use_edns (0, 0, 4096)
-		nsas = []
-		try:
-			for nsa in local_resolver.query (
-					name.from_text (ns),
-					rdtype=rdatatype.AAAA):
-				nsas.append (str (nsa))
-		except resolver.NXDOMAIN:
-			pass
-		try:
-			for nsa in local_resolver.query (
-					name.from_text (ns),
-					rdtype=rdatatype.A):
-				nsas.append (str (nsa))
-		except resolver.NXDOMAIN:
-			pass
+		nsas = name_server_addresses (ns)
 		if len (nsas) > 0:
-			request = message.make_query (
-					name.from_text (zone),
-					rrtype,
-					rdataclass.IN,
-					use_edns=True,
-					# endsflags=0,
-					payload=4096,
-					want_dnssec=True)
-			backoff = 0.10
-			response = None
-			done = False
-			start = time.time ()
-			timeout = local_resolver._compute_timeout (start)
-			while (response is None) and (not done):
-				for nsa in nsas:
-					try:
-						response = query.udp (
-								request,
-								nsa,
-								timeout)
-						errcode = response.rcode ()
-						if errcode == rcode.NOERROR:
-							done = True
-							break
-						if errcode == rcode.YXDOMAIN:
-							raise YXDOMAIN
-						if errcode == rcode.NXDOMAIN:
-							break
-					except:
-						response = None
-						continue
-				try:
-					timeout = local_resolver._compute_timeout (start)
-				except exception.Timeout:
-					done = True
-					break
-				sleep_time = min (timeout, backoff)
-				time.sleep (sleep_time)
-				backoff = backoff * 2
+			response = probe (ns, nsas, zone, rrtype)
 			if response is None:
 				retval.append (None)
 			else:
@@ -183,6 +482,114 @@ def collective_query (zone, rrtype, name_servers, answerproc=None):
 	return retval
 
 
+#
+# Circuit breakers confine a slow or failing upstream to its own zones.
+# They are keyed by the set of name servers that is queried, so the
+# children of one parent share the breaker for its name servers, even
+# when the parent is further up than the label that is cut off the child.
+# After breaker_failures queries in a row fail, the breaker opens and
+# queries under its key fail fast with CircuitOpen, which holds the time
+# in open_until.  When the cooldown has passed, one query is let through as
+# a probe; success closes the breaker, failure opens it again with twice
+# the cooldown, up to breaker_max_cooldown.
+#
+# A query fails when no name server answers, or when most of them do not.
+#
+breaker_failures     = 5
+breaker_cooldown     = 60
+breaker_max_cooldown = 900
+
+class CircuitOpen (Exception):
+	def __init__ (self, message, open_until):
+		Exception.__init__ (self, message)
+		self.open_until = open_until
+
+class Breaker:
+	def __init__ (self):
+		self.failures = 0
+		self.cooldown = breaker_cooldown
+		self.open_until = None
+		self.probing = False
+
+breakers = { }
+breakers_lock = threading.Lock ()
+
+def breaker_key (publisher, nss):
+	if publisher & 0xfffc == PUBLISHER_PARENTS:
+		return ('parent', tuple (sorted (nss)))
+	return ('nsset', tuple (sorted (nss)))
+
+def breaker_name (key):
+	if key [0] == 'parent':
+		return 'parent name servers ' + ' '.join (key [1])
+	return 'name servers ' + ' '.join (key [1])
+
+#
+# Raise CircuitOpen if queries under the key should fail fast, and return
+# whether the query that is let through is a half-open probe
+#
+def breaker_enter (key):
+	now = time.time ()
+	breakers_lock.acquire ()
+	try:
+		brk = breakers.get (key)
+		if brk is None or brk.open_until is None:
+			return False
+		if brk.open_until > now or brk.probing:
+			raise CircuitOpen ('Circuit open for ' + breaker_name (key) + ' until ' + time.ctime (brk.open_until),
+					int (ceil (brk.open_until)))
+		brk.probing = True
+		return True
+	finally:
+		breakers_lock.release ()
+
+def breaker_exit (key, success, probing):
+	breakers_lock.acquire ()
+	try:
+		brk = breakers.get (key)
+		if success:
+			if brk is not None:
+				if brk.open_until is not None:
+					syslog.syslog (syslog.LOG_INFO, 'Circuit closed for ' + breaker_name (key))
+				del breakers [key]
+			return
+		if brk is None:
+			brk = Breaker ()
+			breakers [key] = brk
+		if probing:
+			brk.probing = False
+			brk.cooldown = min (2 * brk.cooldown, breaker_max_cooldown)
+		elif brk.open_until is not None:
+			# Raced with the breaker opening; leave it as it is
+			return
+		else:
+			brk.failures = brk.failures + 1
+			if brk.failures < breaker_failures:
+				return
+		brk.open_until = time.time () + brk.cooldown
+		syslog.syslog (syslog.LOG_WARNING, 'Circuit opened for ' + breaker_name (key) + ' until ' + time.ctime (brk.open_until))
+	finally:
+		breakers_lock.release ()
+
+#
+# Make a collective query at the publisher of a zone, under the protection
+# of its circuit breaker.  Raise CircuitOpen to fail fast.
+#
+def publisher_query (zone, rrtype, publisher, answerproc=None):
+	nss = list_name_servers (zone, publisher)
+	if nss is None:
+		return None
+	key = breaker_key (publisher, nss)
+	probing = breaker_enter (key)
+	success = False
+	try:
+		rrs = collective_query (zone, rrtype, nss, answerproc)
+		success = rrs is not None and 2 * rrs.count (None) <= len (rrs)
+	finally:
+		breaker_exit (key, success, probing)
+	return rrs
+
+
 #
 # Criterium on Response.Answer: Whether it is non-empty, and is signed
 #
@@ -194,6 +601,29 @@ def rrset_is_nonempty_signed (ans):
 	return (len (ans) == 2) and (len (ans [0]) > 0) and (len (ans [1]) > 0)
 
 
+#
+# The local fast path for PUBLISHER_OPENDNSSEC reads the signer's output file
+# instead of querying ods_output; it returns None when this is not possible
+#
+def ods_output_apex (zone, publisher):
+	if not ods_output_zonefiles:
+		return None
+	if publisher & 0xfffc != PUBLISHER_OPENDNSSEC:
+		return None
+	return zonefile.apex (backend.zone_output_dir + '/' + zone, zone)
+
+#
+# For the SOA values under PUBLISHER_OPENDNSSEC, the unsigned input zone may
+# be used as a second local source, if the signer is known to copy them
+#
+def ods_input_apex (zone, publisher):
+	if not ods_input_soa:
+		return None
+	if publisher & 0xfffc != PUBLISHER_OPENDNSSEC:
+		return None
+	return backend.input_apex (zone)
+
+
 #
 # Test if there are DNSKEY records for the given zone
 #
@@ -201,8 +631,10 @@ def rrset_is_nonempty_signed (ans):
 #       for instance during a rollover procedure.
 #
 def test_for_signed_dnskey (zone, publisher):
-	nss = list_name_servers (zone, publisher)
-	rrs = collective_query (zone, rdatatype.DNSKEY, nss, rrset_is_nonempty_signed)
+	apex = ods_output_apex (zone, publisher)
+	if apex is not None:
+		return combine_individual_outcomes ([apex.signed ('DNSKEY')], publisher)
+	rrs = publisher_query (zone, rdatatype.DNSKEY, publisher, rrset_is_nonempty_signed)
 	return combine_individual_outcomes (rrs, publisher)
 
 
@@ -225,16 +657,17 @@ def dnskey_ttl (zone, publisher):
 		except:
 			syslog.syslog (syslog.LOG_ERR, 'Failed to fetch TTL on DNSKEY for ' + zone + '; assuming 1 day')
 			return 86400
-	nss = list_name_servers (zone, publisher)
-	rrs = collective_query (zone, rdatatype.DNSKEY, nss, ttl_of_rrset)
+	apex = ods_output_apex (zone, publisher)
+	if apex is not None and apex.has ('DNSKEY'):
+		return apex.ttl ('DNSKEY')
+	rrs = publisher_query (zone, rdatatype.DNSKEY, publisher, ttl_of_rrset)
 	return max (rrs)
 
 #
 # See if a DS record is published for the given zone
 #
 def have_ds (zone, publisher=PUBLISHER_PARENTS|PUBLISHER_ALL):
-	nss = list_name_servers (zone, publisher)
-	rrs = collective_query (zone, rdatatype.DS, nss, rrset_is_nonempty_signed)
+	rrs = publisher_query (zone, rdatatype.DS, publisher, rrset_is_nonempty_signed)
 	return combine_individual_outcomes (rrs, publisher)
 
 #
@@ -247,8 +680,7 @@ def ds_ttl (zone, publisher=PUBLISHER_PARENTS):
 		except:
 			syslog.syslog (syslog.LOG_ERR, 'Failed to fetch TTL on DS for ' + zone + '; assuming 1 day')
 			return 86400
-	nss = list_name_servers (zone, publisher)
-	rrs = collective_query (zone, rdatatype.DS, nss, ttl_of_rrset)
+	rrs = publisher_query (zone, rdatatype.DS, publisher, ttl_of_rrset)
 	if rrs is not None:
 		return max (rrs)
 	else:
@@ -283,8 +715,11 @@ def negative_caching_ttl (zone, publisher):
 			# In case of doubt, err on the safe side
 			syslog.syslog (syslog.LOG_ERR, 'Failed to fetch negative caching time from SOA for ' + zone + '; assuming 1 day')
 			return 86400
-	nss = list_name_servers (zone, publisher)
-	rrs = collective_query (zone, rdatatype.SOA, nss, soatime)
+	for apex in [ ods_output_apex (zone, publisher),
+			ods_input_apex (zone, publisher) ]:
+		if apex is not None and apex.negative_caching_ttl () is not None:
+			return apex.negative_caching_ttl ()
+	rrs = publisher_query (zone, rdatatype.SOA, publisher, soatime)
 	if rrs is None or len (rrs) == 0 or None in rrs:
 		syslog.syslog (syslog.LOG_ERR, 'Irregularities in negative caching time for ' + zone + '; assuming 1 day')
 		nctime = 86400
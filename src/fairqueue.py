@@ -0,0 +1,89 @@
+# fairqueue.py -- Weighted fair queuing of per-zone work across kids
+#
+# When several DNSSEC Requests are being served at the same time, their
+# per-zone work is put in one queue, and taken out by a fixed number of
+# worker threads.  The order is that of start-time fair queuing: each job
+# is tagged with a virtual finish time, which advances faster for kids with
+# a lower weight in the weights of the access configuration.  A kid with a
+# huge bulk request therefore does not hold up the few zones of another
+# kid; they take turns in proportion to their weights.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import sys
+import heapq
+import itertools
+import threading
+
+
+#
+# The outcome of a job, to be waited for by the submitter
+#
+class Pending:
+
+	def __init__ (self):
+		self.done = threading.Event ()
+		self.result = None
+		self.error = None
+
+	def wait (self):
+		self.done.wait ()
+		if self.error is not None:
+			raise self.error [0], self.error [1], self.error [2]
+		return self.result
+
+
+class FairQueue:
+
+	def __init__ (self, workers=1):
+		self.workers = workers
+		self.started = False
+		self.cond = threading.Condition ()
+		self.vtime = 0.0
+		self.finish = { }
+		self.heap = [ ]
+		self.seq = itertools.count ()
+
+	#
+	# Submit a job, which is a function without arguments, on behalf of a
+	# kid with the given weight, and return a Pending for its outcome
+	#
+	def submit (self, kid, job, weight=1):
+		pending = Pending ()
+		self.cond.acquire ()
+		try:
+			if not self.started:
+				for i in range (self.workers):
+					worker = threading.Thread (target=self.work)
+					worker.daemon = True
+					worker.start ()
+				self.started = True
+			start = max (self.vtime, self.finish.get (kid, 0.0))
+			finish = start + 1.0 / weight
+			self.finish [kid] = finish
+			heapq.heappush (self.heap, (finish, self.seq.next (), start, job, pending))
+			self.cond.notify ()
+		finally:
+			self.cond.release ()
+		return pending
+
+	def work (self):
+		while True:
+			self.cond.acquire ()
+			try:
+				while len (self.heap) == 0:
+					self.cond.wait ()
+				(finish,seq,start,job,pending) = heapq.heappop (self.heap)
+				self.vtime = max (self.vtime, start)
+				if len (self.heap) == 0:
+					# Idle kids should not build up credit
+					self.finish = { }
+			finally:
+				self.cond.release ()
+			try:
+				pending.result = job ()
+			except:
+				pending.error = sys.exc_info ()
+			pending.done.set ()
+
@@ -0,0 +1,197 @@
+# flagevents.py -- Publish changes to the flag registry as events
+#
+# Every change that genericapi.flagged() makes to a flag is appended as one
+# line of JSON to an event journal, holding the zone, the flag, its old and
+# new value, the time of the change and the process id of the writer.
+# Values follow the flag files, so False means absent, True means present
+# but empty, and anything else is the textual content of the flag file.
+#
+# Consumers such as the parenting scripts can remember the byte offset up
+# to which they processed the journal, and use follow() to pick up only the
+# changes since then.  The journal is a single file, so it is friendly to
+# inotify as well.  For immediate wakeup without inotify, a consumer can
+# subscribe(), which binds a Unix datagram socket in the subscribers
+# directory; each event is then also sent to that socket.  Datagrams may
+# be lost when a subscriber is slow, so the journal remains authoritative.
+# The list of subscribers is only read again when the modification time of
+# the directory changes, and sockets of subscribers that went away without
+# unsubscribing are removed.
+#
+# The journal is only appended to; rotation is left to tools like logrotate.
+# Readers restart at the beginning when they notice that the journal has
+# shrunk below their offset.  A journal that grew past the offset again
+# before they looked is told apart by its identity(), the inode and a
+# checksum of the first event.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import zlib
+import time
+import errno
+import socket
+import syslog
+import threading
+
+import json
+
+
+# The append-only journal of flag changes
+journal = '/var/opendnssec/rpc.events'
+
+# The directory in which subscribers bind their Unix datagram sockets
+subscribers = '/var/opendnssec/rpc.subscribers'
+
+
+#
+# Publish one flag change to the journal and to all subscribers
+#
+def publish (zone, flagname, old, new):
+	event = {
+		'zone': zone,
+		'flag': flagname,
+		'old':  old,
+		'new':  new,
+		'time': time.time (),
+		'pid':  os.getpid (),
+	}
+	line = json.dumps (event) + '\n'
+	# A single write with O_APPEND does not interleave with other writers
+	try:
+		fd = os.open (journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+		try:
+			os.write (fd, line)
+		finally:
+			os.close (fd)
+	except OSError, e:
+		syslog.syslog (syslog.LOG_ERR, 'Failed to journal change of ' + flagname + ' flag on ' + zone + ': ' + str (e))
+	notify (line)
+
+
+#
+# The subscribers as last listed, the modification time of their directory
+# at that time, and one socket to send to all of them
+#
+listed = [ ]
+listed_mtime = None
+sender = None
+sender_lock = threading.Lock ()
+
+def notify (line):
+	global listed, listed_mtime, sender
+	sender_lock.acquire ()
+	try:
+		try:
+			mtime = os.stat (subscribers).st_mtime
+		except OSError:
+			return
+		if mtime != listed_mtime:
+			try:
+				listed = os.listdir (subscribers)
+			except OSError:
+				return
+			listed_mtime = mtime
+		if sender is None:
+			sender = socket.socket (socket.AF_UNIX, socket.SOCK_DGRAM)
+			sender.setblocking (0)
+		for name in list (listed):
+			path = subscribers + os.sep + name
+			try:
+				sender.sendto (line, path)
+			except socket.error, e:
+				if e.errno in [errno.ECONNREFUSED, errno.ENOENT]:
+					# The subscriber departed without unsubscribing
+					listed.remove (name)
+					try:
+						os.unlink (path)
+					except OSError:
+						pass
+				# Slow subscribers will find it in the journal
+	finally:
+		sender_lock.release ()
+
+
+#
+# The identity of the journal as an (inode,checksum) tuple, where the
+# checksum covers the first event.  Either is 0 when not known yet, because
+# the journal or its first event is absent.
+#
+def identity ():
+	try:
+		fh = open (journal, 'r')
+	except IOError:
+		return (0, 0)
+	try:
+		ino = os.fstat (fh.fileno ()).st_ino
+		line = fh.readline ()
+	finally:
+		fh.close ()
+	if line [-1:] != '\n':
+		return (ino, 0)
+	return (ino, zlib.crc32 (line) & 0xffffffff or 1)
+
+#
+# Whether an identity may be that of the same journal as a later one; the
+# parts that were not known yet do not count
+#
+def same_journal (old, new):
+	return old [0] in [0, new [0]] and old [1] in [0, new [1]]
+
+
+#
+# Produce (offset,event) tuples for the events in the journal, starting at
+# the given byte offset.  The offset produced is the one just after the
+# event; it can be stored to resume from in a later run.  The generator
+# stops at the current end of the journal.
+#
+def follow (offset=0):
+	try:
+		fh = open (journal, 'r')
+	except IOError:
+		return
+	try:
+		fh.seek (0, 2)
+		if fh.tell () < offset:
+			# The journal was truncated by rotation
+			offset = 0
+		fh.seek (offset)
+		while True:
+			line = fh.readline ()
+			if line [-1:] != '\n':
+				# End of journal, possibly amidst a line being written
+				break
+			offset = offset + len (line)
+			try:
+				event = json.loads (line)
+			except ValueError:
+				syslog.syslog (syslog.LOG_ERR, 'Skipping malformed event in ' + journal)
+				continue
+			yield (offset, event)
+	finally:
+		fh.close ()
+
+
+#
+# Subscribe to events under the given name; return the bound socket, from
+# which each event can be received as a line of JSON.  The caller should
+# call unsubscribe() with the same name when done.
+#
+def subscribe (name):
+	path = subscribers + os.sep + name
+	if not os.path.isdir (subscribers):
+		os.mkdir (subscribers, 0755)
+	if os.path.exists (path):
+		os.unlink (path)
+	sox = socket.socket (socket.AF_UNIX, socket.SOCK_DGRAM)
+	sox.bind (path)
+	return sox
+
+def unsubscribe (name, sox=None):
+	if sox is not None:
+		sox.close ()
+	try:
+		os.unlink (subscribers + os.sep + name)
+	except OSError:
+		pass
+
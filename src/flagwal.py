@@ -0,0 +1,284 @@
+# flagwal.py -- Write-ahead journal for transitions in the flag registry
+#
+# Commands like chain_stop, assert_unsigned and drop_dead change several
+# flags of a zone.  When a process dies halfway, the zone would be left in
+# a state that matches nothing in the lifecycle.  To avoid that, flag
+# changes made during a command are collected in a Group, instead of being
+# written immediately.  Reading a flag while the Group is active produces
+# the pending value, so the command sees its own changes.
+#
+# Each zone of a DNSSEC Request has its own Group.  When the command has
+# finished for the zone, the Group is submitted for commit: its transitions
+# are appended to the write-ahead journal, followed by a commit record, and
+# an fsync() makes them durable.  Only then are the flag files written,
+# after which a done record is appended.  Committing as soon as a zone is
+# done keeps the flags close to the changes made in the backend for that
+# zone.
+#
+# Groups are committed together.  One committer thread takes all Groups
+# that were submitted while it was busy, writes their records at once and
+# covers them with a single fsync(), so the zones of a bulk request share
+# a few fsync() calls instead of one each.  The submitter does not have to
+# wait, and can go on with its next zone; it is told through a callback
+# when the flags are written, and a Commit can be waited for.
+#
+# At startup, servers call recover() to replay any Group that was committed
+# but not done, and to discard any Group that was never committed.  It then
+# empties the journal.
+#
+# Processes that commit hold a shared lock on the journal, and recovery
+# holds an exclusive lock, so it will not mistake a Group that is being
+# written by another process for one that was left behind by a crash.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import sys
+import time
+import fcntl
+import syslog
+import threading
+import itertools
+
+import json
+
+
+# The write-ahead journal, shared by all processes using the flag registry
+walfile = '/var/opendnssec/rpc.wal'
+
+# Recovery also runs after a commit that grows the journal beyond this size
+walsize = 1 << 20
+
+
+#
+# A Group collects flag transitions, in the order in which they were made.
+# It is safe to use from multiple threads.
+#
+class Group:
+
+	counter = itertools.count (1)
+
+	def __init__ (self):
+		self.ident = '%d.%d.%d' % (os.getpid (), int (time.time () * 1000000), Group.counter.next ())
+		self.lock = threading.Lock ()
+		self.pending = { }
+		self.order = [ ]
+
+	def intend (self, zone, flagname, value):
+		self.lock.acquire ()
+		try:
+			key = (zone,flagname)
+			if not self.pending.has_key (key):
+				self.order.append (key)
+			self.pending [key] = value
+		finally:
+			self.lock.release ()
+
+	# Return the pending value for a flag, or None if it was not changed
+	def lookup (self, zone, flagname):
+		self.lock.acquire ()
+		try:
+			return self.pending.get ((zone,flagname))
+		finally:
+			self.lock.release ()
+
+	def transitions (self):
+		self.lock.acquire ()
+		try:
+			return [ (zone, flagname, self.pending [(zone,flagname)])
+				for (zone,flagname) in self.order ]
+		finally:
+			self.lock.release ()
+
+
+#
+# The Group that is active for flag changes made by the current thread
+#
+_local = threading.local ()
+
+def current ():
+	return getattr (_local, 'group', None)
+
+def enter (group):
+	_local.group = group
+
+def leave ():
+	_local.group = None
+
+
+#
+# Open the journal for appending, locked in the given mode
+#
+def _open (lockmode):
+	fd = os.open (walfile, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0644)
+	fcntl.flock (fd, lockmode)
+	return fd
+
+def _append (fd, records):
+	os.write (fd, ''.join ([ json.dumps (rec) + '\n' for rec in records ]))
+
+
+#
+# The commit of a Group, to be waited for by the submitter
+#
+class Commit:
+
+	def __init__ (self, group, apply, then):
+		self.group = group
+		self.apply = apply
+		self.then = then
+		self.transitions = group.transitions ()
+		self.done = threading.Event ()
+		self.error = None
+
+	def wait (self):
+		self.done.wait ()
+		if self.error is not None:
+			raise self.error [0], self.error [1], self.error [2]
+
+	def finish (self):
+		try:
+			if self.then is not None:
+				self.then ()
+		except:
+			if self.error is None:
+				self.error = sys.exc_info ()
+		self.done.set ()
+
+
+submitted = [ ]
+submitted_cond = threading.Condition ()
+committer = None
+
+#
+# Submit a Group for commit: make its transitions durable, then use the
+# apply function to write them to the flag registry as
+# apply (zone, flagname, value), and finally call then() without arguments,
+# also when this failed.  Return a Commit to wait for.
+#
+def submit (group, apply, then=None):
+	global committer
+	pending = Commit (group, apply, then)
+	if len (pending.transitions) == 0:
+		pending.finish ()
+		return pending
+	submitted_cond.acquire ()
+	try:
+		if committer is None:
+			committer = threading.Thread (target=_committer)
+			committer.daemon = True
+			committer.start ()
+		submitted.append (pending)
+		submitted_cond.notify ()
+	finally:
+		submitted_cond.release ()
+	return pending
+
+#
+# Commit a Group and wait until its flags are written
+#
+def commit (group, apply):
+	submit (group, apply).wait ()
+
+def _committer ():
+	global submitted
+	while True:
+		submitted_cond.acquire ()
+		try:
+			while len (submitted) == 0:
+				submitted_cond.wait ()
+			batch = submitted
+			submitted = [ ]
+		finally:
+			submitted_cond.release ()
+		_commit_batch (batch)
+
+#
+# Commit the Groups that were submitted together, with one fsync()
+#
+def _commit_batch (batch):
+	oversized = False
+	try:
+		records = [ ]
+		for pending in batch:
+			ident = pending.group.ident
+			records.extend ([ { 'group': ident, 'zone': zone, 'flag': flagname, 'value': value }
+					for (zone,flagname,value) in pending.transitions ])
+			records.append ( { 'group': ident, 'commit': len (pending.transitions) } )
+		fd = _open (fcntl.LOCK_SH)
+		try:
+			_append (fd, records)
+			os.fsync (fd)
+			for pending in batch:
+				try:
+					for (zone,flagname,value) in pending.transitions:
+						pending.apply (zone, flagname, value)
+				except:
+					pending.error = sys.exc_info ()
+			# Not synced; a replay after a crash is harmless
+			_append (fd, [ { 'group': pending.group.ident, 'done': True }
+					for pending in batch if pending.error is None ])
+			oversized = os.fstat (fd).st_size > walsize
+		finally:
+			os.close (fd)
+	except:
+		for pending in batch:
+			if pending.error is None:
+				pending.error = sys.exc_info ()
+	for pending in batch:
+		pending.finish ()
+	if oversized:
+		recover (batch [0].apply, wait=False)
+
+
+#
+# Replay any Group that was committed but not done, then empty the journal.
+# Without wait, give up when another process is busy committing.
+#
+def recover (apply, wait=True):
+	try:
+		if wait:
+			fd = _open (fcntl.LOCK_EX)
+		else:
+			fd = _open (fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except IOError:
+		return
+	try:
+		groups = { }
+		order = [ ]
+		fh = os.fdopen (os.dup (fd), 'r')
+		fh.seek (0)
+		for line in fh:
+			try:
+				rec = json.loads (line)
+			except ValueError:
+				# Torn write at the end of an uncommitted Group
+				continue
+			ident = rec ['group']
+			if not groups.has_key (ident):
+				groups [ident] = { 'transitions': [ ], 'commit': None, 'done': False }
+				order.append (ident)
+			grp = groups [ident]
+			if rec.has_key ('commit'):
+				grp ['commit'] = rec ['commit']
+			elif rec.has_key ('done'):
+				grp ['done'] = True
+			else:
+				grp ['transitions'].append ( (rec ['zone'], rec ['flag'], rec ['value']) )
+		fh.close ()
+		for ident in order:
+			grp = groups [ident]
+			if grp ['done']:
+				continue
+			if grp ['commit'] != len (grp ['transitions']):
+				syslog.syslog (syslog.LOG_WARNING, 'Discarding uncommitted flag transitions of ' + ident)
+				continue
+			syslog.syslog (syslog.LOG_WARNING, 'Replaying committed flag transitions of ' + ident)
+			for (zone,flagname,value) in grp ['transitions']:
+				apply (zone, flagname, value)
+		os.ftruncate (fd, 0)
+		os.fsync (fd)
+	finally:
+		os.close (fd)
+
@@ -17,25 +17,60 @@ import os
 import os.path
 import syslog
 import time
+import threading
+from math import ceil
 
-from commandaccess import acls
+import accessconfig
 import localrules
 import dnslogic
+import cdsscan
 import backend
+import flagevents
+import flagwal
+import zonelock
+import memo
+import fairqueue
 
 
-# The directory under which the flags are made
-flagdir = '/var/opendnssec/rpc'
+# The directory under which the flags are made; several flag stores can be
+# run side by side on one host, such as for shards, by setting ODSRPC_FLAGDIR
+flagdir = os.environ.get ('ODSRPC_FLAGDIR', '/var/opendnssec/rpc')
+
+# The journals of a flag store are placed next to its directory
+flagevents.journal     = flagdir + '.events'
+flagevents.subscribers = flagdir + '.subscribers'
+flagwal.walfile        = flagdir + '.wal'
+zonelock.lockfile      = flagdir + '.lock'
+memo.flagdir           = flagdir
 
 if not os.path.isdir (flagdir):
 	syslog.syslog (syslog.LOG_ERR, 'Missing control directory: ' + flagdir + ' (FATAL)')
 	sys.exit (1)
 
-# The flagging system; zone name plus flag name; file absense is False
-def flagged (zone, flagname, value=None):
+# The names of all flags that may be stored for a zone
+flagnames = [ 'signing', 'signed', 'chaining', 'chained', 'unchained',
+		'unsigning', 'dsttl', 'dnskeyttl', 'invalid', 'cds' ]
+
+# Read a flag file; empty content is True and file absense is False
+def flagvalue (flagfile):
+	try:
+		fh = open (flagfile, 'r')
+		retval = fh.read ()
+		fh.close ()
+		if retval [-1:] == '\n':
+			retval = retval [:-1]
+		if retval == '':
+			retval = True
+	except:
+		retval = False
+	return retval
+
+# Write a flag file and read it back; zone name plus flag name; file absense is False
+def flagstore (zone, flagname, value=None):
 	error = False
 	flagfile = flagdir + os.sep + zone + os.extsep + flagname
 	if value is not None:
+		oldval = flagvalue (flagfile)
 		if value is not False:
 			try:
 				fh = open (flagfile, 'w')
@@ -54,16 +89,10 @@ def flagged (zone, flagname, value=None):
 			except:
 				# Check below
 				pass
-	try:
-		fh = open (flagfile, 'r')
-		retval = fh.read ()
-		fh.close ()
-		if retval [-1:] == '\n':
-			retval = retval [:-1]
-		if retval == '':
-			retval = True
-	except:
-		retval = False
+	retval = flagvalue (flagfile)
+	if value is not None and retval != oldval:
+		memo.forget (zone)
+		flagevents.publish (zone, flagname, oldval, retval)
 	if value is not None and retval != value:
 		print 'FLAG', flagname, 'IS', retval, '::', type (retval), 'AND SHOULD BE', value, '::', type (value)
 		# It is abnormal for this to happen
@@ -74,6 +103,33 @@ def flagged (zone, flagname, value=None):
 	print 'RETURNING', retval, 'FOR', flagname
 	return retval
 
+# The flagging system; zone name plus flag name; file absense is False.
+# While a flagwal Group is active, changes are collected in the Group and
+# written when it commits; until then, reading produces the pending value.
+def flagged (zone, flagname, value=None):
+	group = flagwal.current ()
+	if group is None:
+		return flagstore (zone, flagname, value)
+	if value is None:
+		value = group.lookup (zone, flagname)
+		if value is None:
+			return flagstore (zone, flagname)
+		return value
+	# Pend the value in the form that it will be read back from the file
+	if not (value is True or value is False):
+		value = str (value)
+		if value [-1:] == '\n':
+			value = value [:-1]
+		if value == '':
+			value = True
+	group.intend (zone, flagname, value)
+	return value
+
+# Complete flag transitions that were committed before a crash; this is
+# for servers to call at startup, and not for tools that only read flags
+def recover ():
+	flagwal.recover (flagstore)
+
 def flagged_signing (zone, value=None):
 	return flagged (zone, 'signing', value)
 
@@ -101,6 +157,151 @@ def flagged_dnskeyttl (zone, value=None):
 def flagged_dsttl (zone, value=None):
 	return flagged (zone, 'dsttl', value)
 
+def flagged_cds (zone, value=None):
+	return flagged (zone, 'cds', value)
+
+# The time of the last CDS scan is the modification time of the cds flag,
+# or None if there is no such flag
+def cds_scantime (zone):
+	try:
+		return os.stat (flagdir + os.sep + zone + os.extsep + 'cds').st_mtime
+	except OSError:
+		return None
+
+# Store the outcome of a CDS scan; the flag is only written when the status
+# changed, so an unchanged scan adds no flag event
+def scanned_cds (zone, status, scantime):
+	if flagvalue (flagdir + os.sep + zone + os.extsep + 'cds') != status:
+		flagged_cds (zone, value=status)
+	os.utime (flagdir + os.sep + zone + os.extsep + 'cds', (scantime, scantime))
+
+
+# Whether the parent publishes DS records for the zone, as found by the last
+# CDS scan if that is fresh and conclusive, or otherwise by querying DNS
+def ds_present (zone):
+	present = cdsscan.ds_present (flagged_cds (zone), cds_scantime (zone))
+	if present is None:
+		present = dnslogic.have_ds (zone)
+	return present
+
+
+# The countdown flags hold the time from which an assertion may succeed
+countdowns = [ 'signed', 'chained', 'unchained', 'unsigning' ]
+
+# Find the end of the countdown on a flag if it has not expired yet, or None
+def countdown_end (zone, flagname):
+	try:
+		endtime = int (flagged (zone, flagname))
+	except:
+		return None
+	if endtime > time.time ():
+		return endtime
+	return None
+
+# Find the earliest countdown that has not expired yet; return None if none
+def ready_at (zone):
+	retval = None
+	for flagname in countdowns:
+		endtime = countdown_end (zone, flagname)
+		if endtime is not None and (retval is None or endtime < retval):
+			retval = endtime
+	return retval
+
+# Aggregate the ready_at times of a DNSSEC Response into a Retry-After value
+def retry_after (resp):
+	times = resp.get ('ready_at', { }).values ()
+	if len (times) == 0:
+		return None
+	return max (1, int (ceil (min (times) - time.time ())))
+
+
+#
+# Scan the flag store once and produce (zone,flags) tuples, where flags is
+# a dictionary holding the values of the flags that are set, zone by zone
+# in sorted order.  When a list of zones is given, only their flag files
+# are read, and all those zones are produced, including the ones without
+# any flags.
+#
+# Without a list of zones, the names in the flag directory are listed and
+# sorted before the first zone is produced, which takes memory for all of
+# them; only the reading of the flag files is spread over the output.
+#
+def scan_flags (zones=None):
+	if zones is not None:
+		for zone in sorted (set (zones)):
+			flags = { }
+			if not dnsre.match (zone):
+				# Not a name that may have flag files
+				yield (zone, flags)
+				continue
+			for flagname in flagnames:
+				value = flagvalue (flagdir + os.sep + zone + os.extsep + flagname)
+				if value is not False:
+					flags [flagname] = value
+			yield (zone, flags)
+		return
+	entries = [ ]
+	for flagfile in os.listdir (flagdir):
+		if not os.extsep in flagfile:
+			continue
+		(fzone,flagname) = flagfile.rsplit (os.extsep, 1)
+		if not flagname in flagnames:
+			continue
+		entries.append ( (fzone,flagname,flagfile) )
+	entries.sort ()
+	zone = None
+	flags = { }
+	for (fzone,flagname,flagfile) in entries:
+		if fzone != zone:
+			if zone is not None:
+				yield (zone, flags)
+			zone = fzone
+			flags = { }
+		value = flagvalue (flagdir + os.sep + flagfile)
+		if value is not False:
+			flags [flagname] = value
+	if zone is not None:
+		yield (zone, flags)
+
+#
+# The lifecycle states of a zone, in the order in which they are passed;
+# unsigned is both the first and last, and invalid may occur anywhere.
+#
+states = [ 'unsigned', 'signing', 'signed', 'chaining', 'chained',
+		'unchaining', 'unchained', 'unsigning', 'invalid' ]
+
+#
+# Derive the lifecycle state from the flags of a zone.  Countdowns that have
+# not expired yet mean that the state before the countdown still applies.
+#
+def zone_state (flags, now=None):
+	if now is None:
+		now = time.time ()
+	def expired (flagname):
+		try:
+			return int (flags [flagname]) <= now
+		except:
+			return False
+	if flags.has_key ('invalid'):
+		return 'invalid'
+	if flags.has_key ('chaining'):
+		if expired ('chained'):
+			return 'chained'
+		return 'chaining'
+	if flags.has_key ('signed'):
+		if flags.has_key ('dsttl'):
+			if expired ('unchained'):
+				return 'unchained'
+			return 'unchaining'
+		if expired ('signed'):
+			return 'signed'
+		return 'signing'
+	if flags.has_key ('signing'):
+		if flags.has_key ('dnskeyttl'):
+			return 'unsigning'
+		return 'signing'
+	return 'unsigned'
+
 
 # Symbolic names for result lists of zones
 RES_OK       = 'ok'
@@ -120,15 +321,60 @@ RES_BADSTATE = 'badstate'
 dnsre = re.compile ('^[0-9a-z]+(-[0-9a-z]+)*(\.[0-9a-z]+(-[0-9a-z])*)+$')
 
 
+#
+# The localrules are called through localrule(), which first looks for an
+# outcome of a batch hook in the context of the current thread.  While the
+# zones of a DNSSEC Request are processed, this context holds the command
+# name and the dictionary returned by its localrules.<command>_many().
+#
+context = threading.local ()
+
+def localrule (command, zone):
+	batch = getattr (context, 'batch', None)
+	if batch is not None:
+		(batchcmd,outcome) = batch
+		if batchcmd == command and outcome.has_key (zone):
+			return outcome [zone]
+	return getattr (localrules, command) (zone)
+
+#
+# The flag checks that a zone must pass before a command reaches its
+# localrule.  For the commands in the precondition table, these are all
+# the checks before the localrule, so the zones that pass are the ones
+# given to a batch hook.
+#
+
+def ready_sign_start (zone):
+	return not (flagged_signing (zone) or flagged_chaining (zone))
+
+def ready_sign_approve (zone):
+	return ready_sign_start (zone) and not flagged_signed (zone)
+
+def ready_assert_signed (zone):
+	return flagged_signing (zone) and not flagged_chaining (zone)
+
+def ready_assert_chained (zone):
+	return flagged_signed (zone) and flagged_chaining (zone)
+
+def ready_sign_ignore (zone):
+	return flagged_signed (zone) and not flagged_chained (zone)
+
+def ready_sign_stop (zone):
+	return ready_sign_ignore (zone)
+
+def ready_update_signed (zone):
+	return flagged_signed (zone)
+
+
 #
 # The individual operations follow, with do_ prefixed to the command name
 #
 
 def do_sign_start (zone, kid):
-	if flagged_signing (zone) or flagged_chaining (zone):
+	if not ready_sign_start (zone):
 		return RES_BADSTATE
 	# No local checks or actions to start signing
-	if localrules.sign_start (zone):
+	if localrule ('sign_start', zone):
 		return RES_OK
 	else:
 		return RES_ERROR
@@ -140,7 +386,13 @@ def do_sign_approve (zone, kid):
 	if flagged_signed (zone):
 		flagged_invalid (zone, value='During sign_approve() of ' + zone + ' the signed flag was already set')
 		return RES_INVALID
-	if not localrules.sign_approve (zone):
+	# The localrules may fetch the input zone
+	if not localrule ('sign_approve', zone):
+		return RES_ERROR
+	# Pre-flight check of the input zone, before adding it to the backend
+	problem = backend.check_zone (zone)
+	if problem is not None:
+		syslog.syslog (syslog.LOG_ERR, problem)
 		return RES_ERROR
 	if backend.manage_zone (zone) != 0:
 		syslog.syslog (syslog.LOG_ERR, 'Failed to add zone ' + zone + ' to OpenDNSSEC')
@@ -152,11 +404,11 @@ def do_sign_approve (zone, kid):
 
 def do_assert_signed (zone, kid):
 	# Precondition testing
-	if (not flagged_signing (zone)) or flagged_chaining (zone):
+	if not ready_assert_signed (zone):
 		return RES_BADSTATE
 	#
 	# Give the local rule logic first chance
-	if not localrules.assert_signed (zone):
+	if not localrule ('assert_signed', zone):
 		return RES_ERROR
 	#
 	# Find if we already set the 'signed' flag to a desired endtime
@@ -208,15 +460,22 @@ def do_chain_start (zone, kid):
 	assn = do_assert_signed (zone, kid)
 	if assn != RES_OK:
 		return assn
+	return start_chain (zone, kid)
+
+# The part of chain_start that follows after assert_signed returned RES_OK
+def start_chain (zone, kid):
 	# Assertion that there is no 'chained' flag yet...
 	if flagged_chained (zone):
 		flagged_invalid (zone, value='The chained flag was already set during chain_start()')
 		return RES_INVALID
 	# ...and that there are no DS records yet...
-	if dnslogic.have_ds (zone):
+	if ds_present (zone):
 		flagged_invalid (zone, value='DS TTL already found in parent')
 	# ... then, continue into the actions for starting the chain
-	if localrules.chain_start (zone):
+	if localrule ('chain_start', zone):
+		# Forget the countdown of a previous chain_stop, if any
+		flagged_dsttl     (zone, value=False)
+		flagged_unchained (zone, value=False)
 		if flagged_chaining (zone, value=True):
 			return RES_OK
 		else:
@@ -228,7 +487,7 @@ def do_chain_start (zone, kid):
 def do_assert_chained (zone, kid):
 	#
 	# First check preconditions
-	if (not flagged_signed (zone)) or (not flagged_chaining (zone)):
+	if not ready_assert_chained (zone):
 		return RES_BADSTATE
 	#
 	# Find if we already set the 'chained' flag to a desired endtime
@@ -243,13 +502,13 @@ def do_assert_chained (zone, kid):
 	# The DS records may be absent, which is a sign that we need to
 	# back off and retry later; this can happen when another process
 	# handles the submission of DS with delays
-	if not dnslogic.have_ds (zone):
+	if not ds_present (zone):
 		return RES_ERROR
 	#
 	# Consider the case that no chaining records may have been found yet;
 	# this will check DNS and store a now-plus-TTL in the 'signed' flag
 	if asserted_fromtm is None:
-		if localrules.assert_chained (zone):
+		if localrule ('assert_chained', zone):
 			ass1tm = dnslogic.ds_ttl (
 					zone,
 					dnslogic.PUBLISHER_PARENTS)
@@ -285,7 +544,7 @@ def do_chain_stop (zone, kid):
 	if dsttl is None:
 		flagged_invalid (zone, value='No DS TTL found in parent')
 	flagged_dsttl (zone, value=str (dsttl))
-	if localrules.chain_stop (zone):
+	if localrule ('chain_stop', zone):
 		if (not flagged_chaining (zone, value=False)) and (not flagged_chained (zone, value=False)):
 			return RES_OK
 		else:
@@ -303,10 +562,10 @@ def do_assert_unchained (zone, kid):
 	except:
 		# flagged_dsttl did not get set by chain_stop() as expected
 		return RES_BADSTATE
-	if dnslogic.have_ds (zone):
+	if ds_present (zone):
 		# We're still waiting for the parent DS to disappear
 		return RES_ERROR
-	if not localrules.assert_unchained (zone):
+	if not localrule ('assert_unchained', zone):
 		# Something local is stopping us from asserting unchained status
 		return RES_ERROR
 	#
@@ -326,16 +585,16 @@ def do_assert_unchained (zone, kid):
 		return RES_OK
 
 def do_sign_ignore (zone, kid):
-	if (not flagged_signed (zone)) or flagged_chained (zone):
+	if not ready_sign_ignore (zone):
 		return RES_BADSTATE
-	if localrules.sign_ignore (zone):
+	if localrule ('sign_ignore', zone):
 		# Name servers reconfigured to no longer serve the zone
 		return RES_OK
 	else:
 		return RES_ERROR
 
 def do_sign_stop (zone, kid):
-	if (not flagged_signed (zone)) or flagged_chained (zone):
+	if not ready_sign_stop (zone):
 		print 'FLAGS ARE OFF -- BADSTATE'
 		return RES_BADSTATE
 	dnskeyttl = dnslogic.dnskey_ttl (
@@ -343,7 +602,7 @@ def do_sign_stop (zone, kid):
 				dnslogic.PUBLISHER_OPENDNSSEC)
 	if flagged_dnskeyttl (zone, value=str (dnskeyttl)) != str (dnskeyttl):
 		return RES_INVALID
-	if not localrules.sign_stop (zone):
+	if not localrule ('sign_stop', zone):
 		return RES_ERROR
 	if backend.unmanage_zone (zone) != 0:
 		syslog.syslog (syslog.LOG_ERR, 'Failed to remove zone ' + zone + ' from OpenDNSSEC')
@@ -374,7 +633,7 @@ def do_assert_unsigned (zone, kid):
 			dnslogic.PUBLISHER_NONE):
 		syslog.syslog (syslog.LOG_INFO, 'Failed to assert that zone ' + zone + ' is published-unsigned')
 		return RES_ERROR
-	if not localrules.assert_unsigned (zone):
+	if not localrule ('assert_unsigned', zone):
 		return RES_ERROR
 	#
 	# The countdown for DNSKEY TTL only starts now, after localrules have
@@ -400,94 +659,154 @@ def do_assert_unsigned (zone, kid):
 			return RES_INVALID
 		flagged_dsttl (zone, value=False)
 		flagged_dnskeyttl (zone, value=False)
+		flagged_unchained (zone, value=False)
 		flagged_unsigning (zone, value=False)
 		return RES_OK
 
+#
+# The status command is read-only, and served by run_status() for all zones
+# at once; the per-zone handler exists for access control and completeness.
+#
+
+def do_status (zone, kid):
+	return RES_OK
+
 #
 # The goto_xxx commands jump around the state diagram until a desired state
 # is reached.  They may need to be called multiple times, so through polling,
 # until they can return a positive response.  They add nothing but simplicity
 # of operation to the foregoing commands.
 #
+# The zone state is derived once from the flags, after which the actions
+# toward the desired state are planned from the transitions table and run
+# in one pass, until one of them fails to return RES_OK.  The assertions
+# that the state already proved from the flags are not repeated.
+#
 
-def do_goto_signed (zone, kid):
+# The state that a zone is in after each action returned RES_OK
+outcome = {
+	'sign_approve':     'signing',
+	'assert_signed':    'signed',
+	'chain_start':      'chaining',
+	'assert_chained':   'chained',
+	'chain_stop':       'unchaining',
+	'assert_unchained': 'unchained',
+	'sign_stop':        'unsigning',
+	'assert_unsigned':  'unsigned',
+}
+
+# For each goto_xxx target, the states that satisfy it
+goals = {
+	'signed':    [ 'signed', 'unchained' ],
+	'chained':   [ 'chained' ],
+	'unchained': [ 'unchained', 'signed' ],
+	'unsigned':  [ 'unsigned' ],
+}
+
+# For each goto_xxx target, the next action to take from each other state
+transitions = { }
+transitions ['signed'] = {
+	'unsigned':   'sign_approve',
+	'signing':    'assert_signed',
+	'chaining':   'assert_chained',
+	'chained':    'chain_stop',
+	'unchaining': 'assert_unchained',
+	'unsigning':  'assert_unsigned',
+}
+transitions ['chained'] = {
+	'unsigned':   'sign_approve',
+	'signing':    'assert_signed',
+	'signed':     'chain_start',
+	'chaining':   'assert_chained',
+	'unchaining': 'assert_unchained',
+	'unchained':  'chain_start',
+	'unsigning':  'assert_unsigned',
+}
+transitions ['unchained'] = transitions ['signed']
+transitions ['unsigned'] = {
+	'signing':    'assert_signed',
+	'signed':     'sign_stop',
+	'chaining':   'assert_chained',
+	'chained':    'chain_stop',
+	'unchaining': 'assert_unchained',
+	'unchained':  'sign_stop',
+	'unsigning':  'assert_unsigned',
+}
+
+# Read all flags of a zone into a dictionary, as scan_flags() would
+def zone_flags (zone):
+	flags = { }
+	for flagname in flagnames:
+		value = flagged (zone, flagname)
+		if value is not False:
+			flags [flagname] = value
+	return flags
+
+# Plan the actions that lead from a state to a goto_xxx target
+def plan_goto (state, target):
+	plan = [ ]
+	while not state in goals [target]:
+		if not transitions [target].has_key (state):
+			return None
+		action = transitions [target] [state]
+		plan.append (action)
+		state = outcome [action]
+	return plan
+
+def run_goto (zone, kid, target):
+	state = zone_state (zone_flags (zone))
+	plan = plan_goto (state, target)
+	print 'goto_' + target, zone, 'from', state, 'plan', plan
+	if plan is None:
+		return RES_BADSTATE
 	rv = RES_OK
-	print 'goto_signed', zone
-	if rv == RES_OK and flagged_signed (zone):
-		if flagged_chaining (zone):
-			print 'goto_signed --> gosub_unchained'
-			rv = do_goto_unchained (zone)
+	for action in plan:
+		if action == 'chain_start':
+			# The assertion of the signed state has already been done
+			rv = start_chain (zone, kid)
 		else:
-			print 'goto_signed --> assert_unchained'
-			rv = do_assert_unchained (zone)
-	if rv == RES_OK and not flagged_signing (zone) and not flagged_signed (zone):
-		#USELESS# print 'goto_signed --> sign_start'
-		#USELESS# rv = do_sign_start (zone, kid)
-		print 'goto_signed --> sign_approve'
-		rv = do_sign_approve (zone, kid)
-	if rv == RES_OK:
-		print 'goto_signed --> assert_signed'
-		rv = do_assert_signed (zone, kid)
-	print 'goto_signed :=', rv
+			rv = run_step (costclass [action], kid, handler [action], zone, kid)
+		print 'goto_' + target, '-->', action, ':=', rv
+		if rv != RES_OK:
+			break
 	return rv
 
+#
+# Run a step of a command in the queue of its cost class, unless the current
+# thread already works for that class.  The step sees the flagwal Group and
+# batch outcome of the current thread, and is queued under the weight of
+# the kid.  The caller waits for it, but a backend worker never waits for
+# another class, so this cannot deadlock.
+#
+def run_step (cost, kid, fun, *args):
+	if cost != COST_BACKEND or getattr (context, 'cost', None) in [ None, cost ]:
+		return fun (*args)
+	group = flagwal.current ()
+	batch = getattr (context, 'batch', None)
+	weight = getattr (context, 'weight', 1)
+	def step ():
+		flagwal.enter (group)
+		context.batch = batch
+		context.cost = cost
+		try:
+			return fun (*args)
+		finally:
+			context.batch = None
+			context.cost = None
+			flagwal.leave ()
+	return queues [cost].submit (kid, step, weight).wait ()
+
+def do_goto_signed (zone, kid):
+	return run_goto (zone, kid, 'signed')
+
 def do_goto_chained (zone, kid):
-	rv = RES_OK
-	print 'goto_chained', zone
-	if rv == RES_OK:
-		if not flagged_signed (zone):
-			print 'goto_chained --> gosub_signed'
-			rv = do_goto_signed (zone, kid)
-		else:
-			print 'goto_chained --> assert_signed'
-			rv = do_assert_signed (zone, kid)
-	if rv == RES_OK and flagged_signing (zone) and not flagged_chaining (zone):
-		print 'goto_chained --> chain_start'
-		rv = do_chain_start (zone, kid)
-	if rv == RES_OK:
-		print 'goto_chained --> assert_chained'
-		rv = do_assert_chained (zone, kid)
-	print 'goto_chained :=', rv
-	return rv
+	return run_goto (zone, kid, 'chained')
 
 def do_goto_unchained (zone, kid):
-	rv = RES_OK
-	print 'goto_unchained', zone
-	if rv == RES_OK and flagged_chaining (zone):
-		if not flagged_chained (zone):
-			print 'goto_unchained --> gosub_chained'
-			rv = do_goto_chained (zone, kid)
-		else:
-			print 'goto_unchained --> assert_chained'
-			rv = do_assert_chained (zone, kid)
-	if rv == RES_OK and flagged_chaining (zone) and flagged_chained (zone):
-		print 'goto_unchained --> chain_stop'
-		rv = do_chain_stop (zone, kid)
-	if rv == RES_OK and not flagged_chaining (zone):
-		print 'goto_unchained --> assert_unchained'
-		rv = do_assert_unchained (zone, kid)
-	print 'goto_unchained :=', rv
-	return rv
+	return run_goto (zone, kid, 'unchained')
 
 def do_goto_unsigned (zone, kid):
-	rv = RES_OK
-	print 'goto_unsigned', zone
-	if rv == RES_OK and flagged_signed (zone):
-		if flagged_chained (zone):
-			print 'goto_unsigned --> gosub_unchained'
-			rv = do_goto_unchained (zone, kid)
-		else:
-			print 'goto_unsigned --> assert_unchained'
-			rv = do_assert_unchained (zone, kid)
-	if rv == RES_OK and flagged_signed (zone) and not flagged_chained (zone):
-		#USELESS# rv = do_sign_ignore (zone, kid)
-		print 'goto_unsigned --> sign_stop'
-		rv = do_sign_stop (zone, kid)
-	if rv == RES_OK and not flagged_signed (zone):
-		print 'goto_unsigned --> assert_unsigned'
-		rv = do_assert_unsigned (zone, kid)
-	print 'goto_unsigned :=', rv
-	return rv
+	return run_goto (zone, kid, 'unsigned')
 
 #
 # The drop_dead command serves a practical use of removing a zone here and now,
@@ -513,6 +832,7 @@ def do_drop_dead (zone, kid):
 	flagged_dnskeyttl (zone, value=False)
 	flagged_unchained (zone, value=False)
 	flagged_unsigning (zone, value=False)
+	flagged_cds       (zone, value=False)
 	print 'drop_dead :=', RES_OK
 	return RES_OK
 
@@ -524,16 +844,42 @@ def do_drop_dead (zone, kid):
 #
 #   ods-signer sign <zone>
 #
+# which is what the default localrules do, in one session for all zones.
+#
 
 def do_update_signed (zone, kid):
-	if not flagged_signed (zone):
+	if not ready_update_signed (zone):
 		return RES_BADSTATE
-	if not localrules.update_signed (zone):
+	if not localrule ('update_signed', zone):
 		return RES_ERROR
 	else:
 		return RES_OK
 
 
+#
+# The per-zone work of commands is scheduled by cost class, each class with
+# its own fair queue and worker threads.  This stops a burst of DNS polls
+# from occupying the workers needed for backend operations, and the other
+# way around.  Flag-only commands never wait for either.  The urgent class
+# is a lane of its own for drop_dead, which must not wait behind a bulk
+# sign_approve in the backend class.
+#
+COST_FLAG    = 'flag'
+COST_DNS     = 'dns'
+COST_BACKEND = 'backend'
+COST_URGENT  = 'urgent'
+
+workers = { }
+workers [COST_FLAG   ] = 2
+workers [COST_DNS    ] = 8
+workers [COST_BACKEND] = 1
+workers [COST_URGENT ] = 1
+
+queues = { }
+for cost in workers.keys ():
+	queues [cost] = fairqueue.FairQueue (workers=workers [cost])
+
+
 #
 # Map command names to the procedures that apply them to individual zones
 #
@@ -554,6 +900,85 @@ handler ['goto_unchained'  ] = do_goto_unchained
 handler ['goto_unsigned'   ] = do_goto_unsigned
 handler ['drop_dead'       ] = do_drop_dead
 handler ['update_signed'   ] = do_update_signed
+handler ['status'          ] = do_status
+
+#
+# Map command names to the cost class of their per-zone work.  The backend
+# class runs the enforcer and signer as subprocesses; the DNS class waits
+# for name servers; the flag class only looks at the flag store.  The goto_
+# commands are mostly DNS polls, and run their backend steps through
+# run_step() in the backend class.
+#
+costclass = { }
+costclass ['sign_start'      ] = COST_FLAG
+costclass ['sign_approve'    ] = COST_BACKEND
+costclass ['assert_signed'   ] = COST_DNS
+costclass ['chain_start'     ] = COST_DNS
+costclass ['assert_chained'  ] = COST_DNS
+costclass ['chain_stop'      ] = COST_DNS
+costclass ['assert_unchained'] = COST_DNS
+costclass ['sign_ignore'     ] = COST_FLAG
+costclass ['sign_stop'       ] = COST_BACKEND
+costclass ['assert_unsigned' ] = COST_DNS
+costclass ['goto_signed'     ] = COST_DNS
+costclass ['goto_chained'    ] = COST_DNS
+costclass ['goto_unchained'  ] = COST_DNS
+costclass ['goto_unsigned'   ] = COST_DNS
+costclass ['drop_dead'       ] = COST_URGENT
+costclass ['update_signed'   ] = COST_BACKEND
+costclass ['status'          ] = COST_FLAG
+
+#
+# Map command names to the flag checks that precede their localrule, for
+# the commands that may have a batch hook in localrules.  Only commands
+# whose handler checks nothing but these flags before the localrule are
+# listed; the others check DNS or query the signer first, and a batch hook
+# would run for zones that the handler then rejects.
+#
+precondition = { }
+precondition ['sign_start'      ] = ready_sign_start
+precondition ['sign_approve'    ] = ready_sign_approve
+precondition ['assert_signed'   ] = ready_assert_signed
+precondition ['sign_ignore'     ] = ready_sign_ignore
+precondition ['update_signed'   ] = ready_update_signed
+
+
+#
+# Report the lifecycle state and flags for the requested zones, or for all
+# zones in the flag store when the DNSSEC Request has no zones list.  When
+# a states list is provided, only zones in one of those states are reported.
+#
+def run_status (zones, states=None):
+	retval = {
+		RES_OK:    [ ],
+		RES_ERROR: [ ],
+		'status':  { },
+	}
+	if zones is not None:
+		wanted = [ ]
+		for zone in zones:
+			zone = zone.lower ()
+			if zone [-1:] == '.':
+				zone = zone [:-1]
+			if dnsre.match (zone):
+				wanted.append (zone)
+			else:
+				retval [RES_ERROR].append (zone)
+		zones = wanted
+	now = time.time ()
+	for (zone,flags) in scan_flags (zones):
+		state = zone_state (flags, now)
+		if states is not None and not state in states:
+			continue
+		retval [RES_OK].append (zone)
+		retval ['status'] [zone] = {
+			'state': state,
+			'flags': flags,
+		}
+	for result in retval.keys ():
+		if len (retval [result]) == 0:
+			del retval [result]
+	return retval
 
 
 #
@@ -561,24 +986,37 @@ handler ['update_signed'   ] = do_update_signed
 # The key identity is assumed to have been verified by the caller through JOSE.
 #  * cmd has 'command' and 'zones' fields, as in the unsigned JSON structure.
 #  * kid holds the key identity for which the command is being requested.
+#  * config is the accessconfig.Snapshot taken for the request, by default
+#    the current one.
 #
-def run_command (cmd, kid):
+def run_command (cmd, kid, config=None):
+	if config is None:
+		config = accessconfig.current ()
 	#
 	# Per-command access control
 	command = cmd ['command']
-	zones   = cmd ['zones'  ]
+	zones   = cmd.get ('zones')
 	if not handler.has_key (command):
 		# Unrecognised command
 		print 'Unrecognised command', command
 		return None
-	welcome = False
-	welcome = welcome or (acls.has_key (  '*'  ) and kid in acls [  '*'  ])
-	welcome = welcome or (acls.has_key (command) and kid in acls [command])
-	if not welcome:
+	if not config.allowed (command, kid):
 		# Refused by ACLs
 		print 'Refused by ACLs'
 		return None
 	#
+	# The status command is answered from one scan of the flag store
+	if command == 'status':
+		wanted = cmd.get ('states')
+		if wanted is not None and (type (wanted) != list or
+				len ([ state for state in wanted if not state in states ]) > 0):
+			print 'Unknown states', wanted
+			return None
+		return run_status (zones, wanted)
+	if zones is None:
+		print 'Missing zones list'
+		return None
+	#
 	# Invoke command-specific handler without further restraint
 	retval = {
 		RES_OK:       [ ],
@@ -586,22 +1024,131 @@ def run_command (cmd, kid):
 		RES_ERROR:    [ ],
 		RES_BADSTATE: [ ],
 	}
-	hdl = handler [command]
-	for zone in zones:
-		zone = zone.lower ()
-		if zone [-1:] == '.':
-			zone = zone [:-1]
-		if not dnsre.match (zone):
-			result = RES_ERROR
-		elif flagged_invalid (zone):
-			result = RES_INVALID
-		else:
-			result = hdl (zone, kid) 
-			if result != RES_INVALID and flagged_invalid (zone):
-				result = RES_INVALID
+	ready = { }
+	reasons = { }
+	queue = queues [costclass [command]]
+	weight = config.weights.get (kid, 1)
+	batch = batch_hook (command, set ([ normalise (zone) for zone in zones ]))
+	def job (zone):
+		# Lock the zone across processes until its flags are committed;
+		# other requests only wait for the zones they have in common
+		held = zonelock.acquire ([ normalise (zone) ])
+		group = flagwal.Group ()
+		flagwal.enter (group)
+		context.batch = batch
+		context.cost = costclass [command]
+		context.weight = weight
+		try:
+			outcome = run_zone (command, zone, kid)
+		except:
+			flagwal.leave ()
+			try:
+				flagwal.commit (group, flagstore)
+			finally:
+				zonelock.release (held)
+			raise
+		finally:
+			context.batch = None
+			context.cost = None
+		flagwal.leave ()
+		# The flags follow the backend and localrules zone by zone, so
+		# commit them now, together with those of other zones that are
+		# done; the worker goes on while the commit is being synced
+		def written ():
+			try:
+				remember (command, outcome)
+			finally:
+				zonelock.release (held)
+		return (outcome, flagwal.submit (group, flagstore, written))
+	pending = [ queue.submit (kid, lambda zone=zone: job (zone), weight)
+			for zone in zones ]
+	outcomes = [ ]
+	for (outcome,committed) in [ done.wait () for done in pending ]:
+		committed.wait ()
+		outcomes.append (outcome)
+	for (zone,result,endtime,fresh,reason) in outcomes:
 		retval [result].append (zone)
+		if endtime is not None:
+			ready [zone] = endtime
+		if reason is not None:
+			reasons [zone] = reason
 	for result in retval.keys ():
 		if len (retval [result]) == 0:
 			del retval [result]
+	if len (ready) > 0:
+		retval ['ready_at'] = ready
+	if len (reasons) > 0:
+		retval ['reason'] = reasons
 	return retval
 
+#
+# Remember a fresh outcome of run_zone() in memo, once its flags have been
+# committed.  An error lasts until the end of the command's own countdown,
+# if that is running; other results may depend on DNS.
+#
+def remember (command, outcome):
+	(zone,result,endtime,fresh,reason) = outcome
+	if not fresh or result == RES_INVALID or not command in memo.commands:
+		return
+	deadline = None
+	if result == RES_ERROR:
+		deadline = countdown_end (zone, memo.countdown [command])
+	memo.store (zone, command, result, endtime, deadline)
+
+#
+# Call the batch hook for a command, if localrules has one, with the zones
+# that are ready for it.  This runs in the thread of the request, before its
+# zones are queued, so a long batch does not hold a worker of the queues
+# that other kids are waiting for.  Return None or the command and the
+# outcome of the batch hook.
+#
+def batch_hook (command, zones):
+	many = getattr (localrules, command + '_many', None)
+	ready = precondition.get (command)
+	if many is None or ready is None:
+		return None
+	candidates = [ zone for zone in sorted (zones)
+			if dnsre.match (zone) and not flagged_invalid (zone) and ready (zone)
+			and memo.lookup (zone, command) is None ]
+	if len (candidates) == 0:
+		return (command, { })
+	return (command, many (candidates) or { })
+
+#
+# Normalise a zone name to lowercase without trailing dot
+#
+def normalise (zone):
+	zone = zone.lower ()
+	if zone [-1:] == '.':
+		zone = zone [:-1]
+	return zone
+
+#
+# Run a command handler for a zone, and return a tuple with the normalised
+# zone name, the result, the end of a running countdown, if any, whether
+# the result is fresh rather than remembered by memo, and the reason for
+# an error that was not caused by the zone itself, if any
+#
+def run_zone (command, zone, kid):
+	zone = normalise (zone)
+	if not dnsre.match (zone):
+		return (zone, RES_ERROR, None, False, None)
+	remembered = memo.lookup (zone, command)
+	if remembered is not None:
+		(result,endtime) = remembered
+		return (zone, result, endtime, False, None)
+	if flagged_invalid (zone):
+		result = RES_INVALID
+	else:
+		try:
+			result = handler [command] (zone, kid)
+		except dnslogic.CircuitOpen, e:
+			# Failing fast on a troubled upstream is not to be remembered;
+			# the poll is useless until the breaker lets a query through
+			return (zone, RES_ERROR, e.open_until, False, str (e))
+		if result != RES_INVALID and flagged_invalid (zone):
+			result = RES_INVALID
+	endtime = None
+	if result == RES_ERROR:
+		endtime = ready_at (zone)
+	return (zone, result, endtime, True, None)
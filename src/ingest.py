@@ -0,0 +1,252 @@
+# ingest.py -- Transfer unsigned zones from a hidden primary into the backend
+#
+# The backend takes the unsigned zone for <zone> from the file <zone>.axfr
+# in its zone_input_dir.  When a hidden primary is configured here, this
+# module fetches those files with zone transfers, for many zones at once.
+#
+# Each file starts with the SOA record of the zone, and its serial is used
+# for the next transfer, which can then be an IXFR that only carries the
+# differences.  Since the serial is part of the file that was installed,
+# it cannot disagree with the records after a crash.  An IXFR is
+# applied while streaming the old file to the new one; an AXFR is streamed
+# to disk as it arrives.  Only the differences of an IXFR are held in
+# memory, never a whole zone.  New files are written under a temporary
+# name and renamed into place, so the signer never sees a partial zone.
+#
+# Files are written with one record per line, with absolute names and
+# explicit TTL and class, which is also what IXFR relies on to find the
+# records to delete.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import syslog
+import threading
+import itertools
+
+from multiprocessing.pool import ThreadPool
+
+import dns.query
+import dns.exception
+from dns import name, rdatatype, rdataclass
+
+import backend
+
+
+# The address of the hidden primary, or None to leave the input files to
+# another process
+primary = None
+
+# The port of the hidden primary
+port = 53
+
+# The number of zones transferred concurrently
+workers = 8
+
+# The timeout in seconds for each message, and for a whole transfer
+timeout = 30
+lifetime = 3600
+
+
+def input_file (zone):
+	return backend.zone_input_dir + os.sep + zone + '.axfr'
+
+# The serial in the SOA record on the first line of the current input file,
+# or None if it has no such line
+def current_serial (zone):
+	try:
+		fh = open (input_file (zone))
+		try:
+			line = fh.readline ()
+		finally:
+			fh.close ()
+	except IOError:
+		return None
+	reckey = key (line)
+	if reckey is None or reckey [2] != 'SOA':
+		return None
+	try:
+		return int (reckey [3].split () [2])
+	except (IndexError, ValueError):
+		return None
+
+
+#
+# The records of a transfer, as (text,key,serial) tuples, with the line of
+# text for the record, its key for matching deletions and, for SOA records,
+# the serial
+#
+def records (messages):
+	for msg in messages:
+		for rrset in msg.answer:
+			for rdata in rrset:
+				text = '%s\t%d\t%s\t%s\t%s\n' % (
+					rrset.name.to_text (),
+					rrset.ttl,
+					rdataclass.to_text (rrset.rdclass),
+					rdatatype.to_text (rrset.rdtype),
+					rdata.to_text ())
+				serial = None
+				if rrset.rdtype == rdatatype.SOA:
+					serial = rdata.serial
+				yield (text, key (text), serial)
+
+# The key of a line in an input file; the TTL is not part of it
+def key (text):
+	fields = text.split (None, 4)
+	if len (fields) < 5:
+		return None
+	(owner,ttl,cls,rrtype,rdata) = fields
+	return (owner.lower (), cls.upper (), rrtype.upper (), ' '.join (rdata.split ()))
+
+
+#
+# Write a new file through a temporary file that is renamed into place
+#
+class Replacement:
+
+	def __init__ (self, path):
+		self.path = path
+		self.temp = path + '.tmp.' + str (os.getpid ()) + '.' + threading.current_thread ().name
+		self.fh = open (self.temp, 'w')
+
+	def write (self, text):
+		self.fh.write (text)
+
+	def commit (self):
+		self.fh.flush ()
+		os.fsync (self.fh.fileno ())
+		self.fh.close ()
+		os.rename (self.temp, self.path)
+
+	def abort (self):
+		self.fh.close ()
+		try:
+			os.unlink (self.temp)
+		except OSError:
+			pass
+
+
+
+#
+# Transfer a zone and return its new serial.  The transfer is incremental
+# when the serial of the current input file is known, unless that is not
+# wanted.
+#
+def transfer (zone, incremental=True):
+	oldserial = None
+	if incremental:
+		oldserial = current_serial (zone)
+	if oldserial is None:
+		messages = dns.query.xfr (primary, name.from_text (zone),
+				rdtype=rdatatype.AXFR, port=port,
+				timeout=timeout, lifetime=lifetime, relativize=False)
+	else:
+		messages = dns.query.xfr (primary, name.from_text (zone),
+				rdtype=rdatatype.IXFR, serial=oldserial, port=port,
+				timeout=timeout, lifetime=lifetime, relativize=False)
+	stream = records (messages)
+	(text,soakey,newserial) = stream.next ()
+	if newserial == oldserial:
+		# The input file is up to date
+		for rest in stream:
+			pass
+		return newserial
+	out = Replacement (input_file (zone))
+	try:
+		try:
+			(text2,key2,serial2) = stream.next ()
+		except StopIteration:
+			raise dns.exception.FormError ('Transfer of ' + zone + ' holds only an SOA')
+		if oldserial is None or serial2 is None:
+			# AXFR, or an IXFR answered in AXFR style; all SOA records
+			# after the first repeat it
+			out.write (text)
+			if serial2 is None:
+				out.write (text2)
+			for (text,_,serial) in stream:
+				if serial is None:
+					out.write (text)
+		else:
+			apply_ixfr (zone, stream, (text2,key2,serial2), out)
+		out.commit ()
+	except:
+		out.abort ()
+		raise
+	return newserial
+
+#
+# Collect the differences of an IXFR and apply them to the current input
+# file while streaming it to the new one
+#
+def apply_ixfr (zone, stream, first, out):
+	deletions = set ()
+	additions = { }
+	order = [ ]
+	# The first SOA toggles from the additions of the initial SOA to the
+	# deletions of the first difference
+	adding = True
+	pending = None
+	for (text,reckey,serial) in itertools.chain ([ first ], stream):
+		if pending is not None:
+			deletions.add (pending [1])
+			if additions.has_key (pending [1]):
+				del additions [pending [1]]
+			pending = None
+		if serial is not None:
+			adding = not adding
+			if not adding:
+				# Either the start of the next difference or the end
+				pending = (text, reckey)
+				continue
+		if adding:
+			if not additions.has_key (reckey):
+				order.append (reckey)
+			additions [reckey] = text
+		else:
+			deletions.add (reckey)
+			if additions.has_key (reckey):
+				del additions [reckey]
+	if pending is None:
+		raise dns.exception.FormError ('Incomplete IXFR of ' + zone)
+	# The SOA first, then the old records that remain, then the new ones
+	added = [ reckey for reckey in order if additions.has_key (reckey) ]
+	for reckey in added:
+		if reckey [2] == 'SOA':
+			out.write (additions [reckey])
+	for line in open (input_file (zone)):
+		if key (line) not in deletions:
+			out.write (line)
+	for reckey in added:
+		if reckey [2] != 'SOA':
+			out.write (additions [reckey])
+
+
+#
+# Transfer a zone, falling back to AXFR if IXFR fails; return True on success
+#
+def ingest_zone (zone):
+	try:
+		try:
+			transfer (zone)
+		except Exception, e:
+			if current_serial (zone) is None:
+				raise
+			syslog.syslog (syslog.LOG_INFO, 'IXFR of ' + zone + ' failed, trying AXFR: ' + str (e))
+			transfer (zone, incremental=False)
+		return True
+	except Exception, e:
+		syslog.syslog (syslog.LOG_ERR, 'Failed to transfer ' + zone + ' from ' + str (primary) + ': ' + str (e))
+		return False
+
+#
+# Transfer many zones concurrently, and return a dictionary that maps each
+# zone to True on success or False on failure
+#
+def ingest_zones (zones):
+	pool = ThreadPool (workers)
+	try:
+		return dict (pool.imap_unordered (lambda zone: (zone, ingest_zone (zone)), zones))
+	finally:
+		pool.close ()
@@ -7,6 +7,21 @@
 # Keys and signatures are not handled here.  ACLs and states are also handled
 # externally, as part of the genericapi.
 #
+# A function may be accompanied by a batch variant, whose name has _many
+# appended.  It is called with a list of zones and returns a dictionary that
+# maps zones to True or False.  When present, it is called once for the zones
+# of a DNSSEC Request that pass the flag checks for the command, in the
+# thread of the request rather than by a worker of the command queues, and
+# its outcome is used instead of calling the per-zone function.  Zones that are
+# missing from the dictionary fall back to the per-zone function.
+#
+# Batch variants are only used for sign_start, sign_approve, assert_signed,
+# sign_ignore and update_signed, which check nothing but flags before their
+# local rule; for other commands, only the per-zone function is called.
+# Still, a batch variant must be safe to run for a zone that then fails,
+# for instance because another request changed its flags in the meantime,
+# or because sign_approve finds a problem in the fetched input zone.
+#
 # In addition, a few local settings are defined, such as:
 #  * dig_ods is a "dig" command aimed at the OpenDNSSEC signer's output
 #
@@ -17,6 +32,9 @@ import os
 
 import dns.resolver
 
+import backend
+import ingest
+
 
 #
 # The name server that publishes OpenDNSSEC output (and makes it available to
@@ -25,6 +43,22 @@ import dns.resolver
 ods_output = 'localhost'
 
 
+#
+# The signed zone files that OpenDNSSEC writes to the backend's
+# zone_output_dir are read directly, instead of querying ods_output for the
+# zone's apex, when this is set.  This assumes that ods_output serves
+# precisely these files.
+#
+ods_output_zonefiles = True
+
+#
+# The SOA TTL and SOA.MINIMUM of the unsigned input zone files may be used
+# when the signed output is not available locally.  Set this only when the
+# signer policy does not override these values.
+#
+ods_input_soa = False
+
+
 #
 # The local resolver is the default resolver for the entire Internet
 #
@@ -62,8 +96,14 @@ def sign_start (zone):
 	return True
 
 def sign_approve (zone):
-	# No impact on the local implementation
-	return True
+	# Fetch the unsigned zone, if ingest has a hidden primary
+	return sign_approve_many ([zone]).get (zone, False)
+
+def sign_approve_many (zones):
+	# Fetch the unsigned zones concurrently, if ingest has a hidden primary
+	if ingest.primary is None:
+		return dict ([ (zone, True) for zone in zones ])
+	return ingest.ingest_zones (zones)
 
 def assert_signed (zone):
 	# No impact on the local implementation
@@ -98,6 +138,11 @@ def assert_unsigned (zone):
 	return True
 
 def update_signed (zone):
-	# No impact on the local implementation
-	return True
+	# Have the signer sign the zone afresh
+	return update_signed_many ([zone]).get (zone, False)
+
+def update_signed_many (zones):
+	# Have the signer sign the zones afresh, in one ods-signer session
+	done = backend.sign_zones (zones)
+	return dict ([ (zone, zone in done) for zone in zones ])
 
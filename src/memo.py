@@ -0,0 +1,160 @@
+# memo.py -- Short-lived memory of the results of assertion commands
+#
+# Portals may poll assert_signed or assert_chained for the same zones over
+# and over again.  While a countdown is running, the answer cannot change
+# until its deadline passes, and yet every poll would look at the flags and
+# often at DNS.  This module remembers the result for a zone and command,
+# together with the end of its countdown, if any.
+#
+# A remembered error is valid until the deadline of the countdown that the
+# command itself waits for, such as the signed flag for assert_signed,
+# because each of these commands fails while that countdown runs, whatever
+# DNS shows.  Other results may depend on DNS, and are only valid for a
+# short floor period.
+#
+# A result is forgotten as soon as any flag of the zone changes.  Changes
+# made by this process are reported through forget(), and those of other
+# processes are picked up from the flagevents journal.  Programs that write
+# flag files without journaling, such as contrib/fast-forward-timers, are
+# noticed by the modification of the countdown flag file of the command.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import time
+import threading
+
+import flagevents
+
+
+# The commands whose results may be remembered, with the countdown flag
+# that each of them waits for
+countdown = {
+	'assert_signed':    'signed',
+	'assert_chained':   'chained',
+	'assert_unchained': 'unchained',
+	'assert_unsigned':  'unsigning',
+}
+commands = countdown.keys ()
+
+# The number of seconds that results without a deadline are remembered
+floor = 30
+
+# Expired entries are removed when a new one would pass this number
+prune_size = 10000
+
+# The directory with the flag files, as set by genericapi
+flagdir = '/var/opendnssec/rpc'
+
+
+entries = { }
+lock = threading.Lock ()
+
+# The offset up to which the journal was read, or None before the first use
+offset = None
+
+
+#
+# Forget the results for a zone, because its flags changed
+#
+def forget (zone):
+	lock.acquire ()
+	try:
+		for command in commands:
+			if entries.has_key ((zone,command)):
+				del entries [(zone,command)]
+	finally:
+		lock.release ()
+
+#
+# Forget the results for zones with flag changes in the journal that have
+# not been seen yet.  Only the size of the journal is looked at when there
+# are no such changes.
+#
+def catch_up ():
+	global offset
+	try:
+		size = os.stat (flagevents.journal).st_size
+	except OSError:
+		size = 0
+	lock.acquire ()
+	try:
+		if offset is None:
+			# Nothing was remembered before this point
+			offset = size
+			return
+		if size == offset:
+			return
+		if size < offset:
+			# The journal was rotated and may have lost events
+			entries.clear ()
+			offset = 0
+		for (offset,event) in flagevents.follow (offset):
+			if event.get ('pid') == os.getpid ():
+				# Reported through forget() when it was made
+				continue
+			for command in commands:
+				if entries.has_key ((event ['zone'],command)):
+					del entries [(event ['zone'],command)]
+	finally:
+		lock.release ()
+
+#
+# The modification stamp of the countdown flag file of a command for a zone
+#
+def stamp (zone, command):
+	try:
+		st = os.stat (flagdir + os.sep + zone + os.extsep + countdown [command])
+		return (st.st_ino, st.st_size, st.st_mtime)
+	except OSError:
+		return None
+
+#
+# Return the remembered (result,endtime) for a zone and command, or None
+#
+def lookup (zone, command):
+	if not command in commands:
+		return None
+	catch_up ()
+	lock.acquire ()
+	try:
+		entry = entries.get ((zone,command))
+	finally:
+		lock.release ()
+	if entry is None:
+		return None
+	(result,endtime,validity,flagstamp) = entry
+	if time.time () >= validity or stamp (zone, command) != flagstamp:
+		lock.acquire ()
+		try:
+			if entries.get ((zone,command)) is entry:
+				del entries [(zone,command)]
+		finally:
+			lock.release ()
+		return None
+	return (result,endtime)
+
+#
+# Remember the result for a zone and command, with the end of a running
+# countdown to report or None, and the deadline of the command's own
+# countdown if the result holds until then, or None if the result may
+# depend on DNS.  Call this after the flags of the zone were written.
+#
+def store (zone, command, result, endtime, deadline=None):
+	if not command in commands:
+		return
+	now = time.time ()
+	validity = now + floor
+	if deadline is not None:
+		validity = deadline
+	flagstamp = stamp (zone, command)
+	lock.acquire ()
+	try:
+		if len (entries) >= prune_size:
+			for (key,entry) in entries.items ():
+				if entry [2] <= now:
+					del entries [key]
+		entries [(zone,command)] = (result,endtime,validity,flagstamp)
+	finally:
+		lock.release ()
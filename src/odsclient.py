@@ -0,0 +1,232 @@
+# odsclient.py -- Client library for the ods-webapi
+#
+# This module lets a portal send DNSSEC Requests to ods-webapi without
+# shelling out to ods-webclient.  The Client class is synchronous and may
+# be shared between threads; it draws HTTP connections from a pool, so
+# that concurrent requests do not pay for a TCP handshake each time.
+#
+# Python 2 does not have asyncio, so the asynchronous interface is built on
+# a thread pool instead; request_async() returns an AsyncResult whose get()
+# method delivers the DNSSEC Response, or an optional callback receives it.
+#
+# The drive_to() helper polls a goto_xxx command until all zones have
+# arrived in the desired state, or until they end up in a state that
+# polling cannot resolve.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import time
+import errno
+import socket
+import threading
+import httplib
+import Queue
+
+from multiprocessing.pool import ThreadPool
+
+import odsjose
+
+
+# The shortest sleep of drive_to(), even when hints say the zones are ready
+min_wait = 1
+
+
+#
+# Exception raised when the ods-webapi did not produce a verified response
+#
+class RPCError (Exception):
+	pass
+
+#
+# Exception raised when the ods-webapi refused the request with an HTTP
+# status such as 400 or 403; retry_after holds the number of seconds from
+# its Retry-After header, or None
+#
+class Refused (RPCError):
+	def __init__ (self, status, retry_after=None, message=None):
+		RPCError.__init__ (self, message or 'HTTP status ' + str (status))
+		self.status = status
+		self.retry_after = retry_after
+
+#
+# Exception raised when the ods-webapi throttled the request; retry_after
+# holds the number of seconds after which it may be retried
+#
+class Throttled (Refused):
+	def __init__ (self, retry_after):
+		Refused.__init__ (self, 429, retry_after, 'Throttled for ' + str (retry_after) + ' seconds')
+
+
+#
+# Whether an exception shows that the server closed the connection before
+# it sent anything, rather than a timeout or a broken response
+#
+def closed_by_server (e):
+	if isinstance (e, httplib.BadStatusLine):
+		return e.line in ['', "''"] or e.line.startswith ('No status line received')
+	if isinstance (e, socket.timeout):
+		return False
+	return getattr (e, 'errno', None) in [errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED]
+
+
+#
+# The client, sending DNSSEC Requests to one ods-webapi server
+#
+class Client:
+
+	def __init__ (self, keys, kid=None, host='localhost', port=8000, poolsize=8, timeout=120):
+		if kid is None:
+			kid = keys.keys () [0]
+		self.keys = keys
+		self.kid = kid
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self.pool = Queue.Queue (poolsize)
+		self.workers = None
+		self.workers_lock = threading.Lock ()
+
+	#
+	# Connection pool; connections that failed are not returned.  Return
+	# a connection and whether it was reused from the pool.
+	#
+	def _connection (self):
+		try:
+			return (self.pool.get_nowait (), True)
+		except Queue.Empty:
+			return (httplib.HTTPConnection (self.host, self.port, timeout=self.timeout), False)
+
+	def _release (self, http):
+		try:
+			self.pool.put_nowait (http)
+		except Queue.Full:
+			http.close ()
+
+	def close (self):
+		while True:
+			try:
+				self.pool.get_nowait ().close ()
+			except Queue.Empty:
+				break
+		if self.workers is not None:
+			self.workers.close ()
+			self.workers = None
+
+	#
+	# Send a signed command over a pooled connection; return the HTTP
+	# status, the response headers and the response body.  A pooled
+	# connection may have been closed by the server while idle, which is
+	# why the request is sent again when a reused connection fails before
+	# any response arrived.  Other failures are not retried, because the
+	# server may have run the command, and not all commands can be run
+	# twice.
+	#
+	def _post (self, content):
+		while True:
+			(http,reused) = self._connection ()
+			responding = False
+			try:
+				http.request ('POST', '/', content, { 'Content-type': 'application/jose' })
+				htresp = http.getresponse ()
+				responding = True
+				body = htresp.read ()
+			except (httplib.HTTPException, IOError), e:
+				http.close ()
+				if reused and not responding and closed_by_server (e):
+					continue
+				raise RPCError ('HTTP failure: ' + str (e))
+			self._release (http)
+			return (htresp.status, dict (htresp.getheaders ()), body)
+
+	#
+	# Run a command on a list of zones and return the verified DNSSEC Response.
+	#
+	def request (self, command, zones):
+		cmd = {
+			'command': command,
+			'zones': list (zones),
+		}
+		return self.request_cmd (cmd)
+
+	#
+	# Send a complete DNSSEC Request and return the verified DNSSEC Response.
+	#
+	def request_cmd (self, cmd):
+		(status,headers,body) = self._post (odsjose.sign (cmd, self.kid, self.keys))
+		try:
+			retry = int (headers.get ('retry-after', ''))
+		except ValueError:
+			retry = None
+		if status == 429:
+			raise Throttled (retry or 1)
+		if 400 <= status < 500 or status == 503:
+			raise Refused (status, retry)
+		if status != 200:
+			raise RPCError ('HTTP status ' + str (status))
+		verified = odsjose.verify (body, self.keys)
+		if verified is None:
+			raise RPCError ('Response failed verification')
+		(claims,kid) = verified
+		return claims
+
+	#
+	# Asynchronous variant of request(), served from a thread pool that
+	# is as large as the connection pool.
+	#
+	def request_async (self, command, zones, callback=None):
+		self.workers_lock.acquire ()
+		try:
+			if self.workers is None:
+				self.workers = ThreadPool (self.pool.maxsize)
+		finally:
+			self.workers_lock.release ()
+		return self.workers.apply_async (self.request, (command, zones), callback=callback)
+
+	#
+	# Poll goto_<state> until the zones are all in the given state, or have
+	# ended up in a final list such as invalid or badstate.  Zones reported
+	# as error are retried at the earliest ready_at time hinted by the
+	# server or, lacking hints, after a backoff that doubles until maxbackoff.
+	# No sleep is shorter than min_wait, and at most maxattempts requests are
+	# sent.  The merged DNSSEC Response is returned; zones that did not arrive
+	# before the deadline given by maxwait are listed as error.
+	#
+	def drive_to (self, state, zones, maxwait=None, backoff=5, maxbackoff=300, maxattempts=100):
+		command = 'goto_' + state
+		if maxwait is not None:
+			deadline = time.time () + maxwait
+		else:
+			deadline = None
+		retval = { }
+		pending = list (zones)
+		attempts = 0
+		while len (pending) > 0:
+			attempts = attempts + 1
+			try:
+				resp = self.request (command, pending)
+			except Throttled, thr:
+				delay = max (min_wait, thr.retry_after)
+				if attempts >= maxattempts or (deadline is not None and time.time () + delay > deadline):
+					break
+				time.sleep (delay)
+				continue
+			pending = resp.get ('error', [])
+			for (result,done) in resp.items ():
+				if result not in ['error', 'ready_at', 'reason']:
+					retval.setdefault (result, []).extend (done)
+			if len (pending) == 0:
+				break
+			ready = resp.get ('ready_at', { })
+			if len (ready) == len (pending):
+				delay = max (min_wait, min (ready.values ()) - time.time ())
+			else:
+				delay = max (min_wait, backoff)
+				backoff = min (2 * backoff, maxbackoff)
+			if attempts >= maxattempts or (deadline is not None and time.time () + delay > deadline):
+				break
+			time.sleep (delay)
+		if len (pending) > 0:
+			retval ['error'] = pending
+		return retval
+
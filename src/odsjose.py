@@ -0,0 +1,84 @@
+# odsjose.py -- JOSE signing and verification shared by the ods-rpc programs
+#
+# The ods-webapi frontend and its clients exchange DNSSEC Requests and DNSSEC
+# Responses in the application/jose format, that is JWS Compact Serialisation.
+# Both sides sign with a key from keyconfig, and both sides verify the key
+# identity and timestamp of what they receive.  This module holds that logic
+# so it is written only once.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import time
+
+import base64
+import json
+import jose
+
+
+#
+# The window of acceptable timestamp age, in seconds.  A bit of clock skew
+# is welcomed in the negative direction; replays are limited in the positive.
+#
+age_min = -50
+age_max =  60
+
+
+#
+# Unpack the application/jose transmission format (one element)
+#
+def b64pad (b64):
+	return b64 + '=' * (4 - (len(b64) % 4))
+
+def b64bin (b64):
+	return base64.urlsafe_b64decode (b64pad (b64))
+
+def b64json (b64):
+	return json.loads (b64bin (b64))
+
+
+#
+# Sign a JSON-able object with the key for the given kid, and return the
+# text in JWS Compact Serialisation.
+#
+def sign (content, kid, keys):
+	hdr = {
+		'cty': 'application/json',
+		'kid': kid,
+		'timestamp': time.time (),
+	}
+	return '.'.join (jose.sign (content, keys [kid], add_header = hdr))
+
+
+#
+# Verify a text in JWS Compact Serialisation against the keys, and check
+# its timestamp.  Return a tuple (claims,kid) on success, or None when the
+# signature, key identity or timestamp fail to meet expectations.
+#
+def verify (content, keys):
+	try:
+		(header,payload,signature) = content.split ('.')
+		signeddata = jose.JWS (
+			header,
+			payload,
+			signature,
+		)
+		josehdrs = b64json (header)
+		kid = josehdrs ['kid']
+		age = time.time () - float (josehdrs ['timestamp'])
+	except Exception, e:
+		print 'EXCEPTION:', e
+		return None
+	if not age_min < age < age_max:
+		print 'TIMESTAMP OUT OF WINDOW, AGE', age
+		return None
+	if not keys.has_key (kid):
+		print 'UNKNOWN KEY IDENTITY', kid
+		return None
+	try:
+		jwt = jose.verify (signeddata, keys [kid])
+	except Exception, e:
+		print 'VERIFICATION EXCEPTION:', e
+		return None
+	return (jwt.claims, kid)
+
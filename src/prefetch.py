@@ -0,0 +1,148 @@
+# prefetch.py -- Query DNS for zones whose countdown is about to end
+#
+# When the countdown of a zone ends, the next poll by the portal moves it
+# on, and that usually involves querying the parent name servers for DS.
+# Without help, all that latency lands on the caller.  The prefetcher runs
+# as a background thread in ods-webapi and looks at the countdown flags;
+# shortly before a deadline passes, it makes the queries that the poll
+# will make, so that the poll finds the responses in the probe cache of
+# dnslogic.  Only the DS countdowns are warmed; after the unsigning
+# countdown, assert_unsigned only looks at its flags.
+#
+# The queries are made within a budget of queries per second, so a batch
+# of zones with the same deadline does not flood the name servers.  This
+# includes the lookup of the parent name servers, which is charged before
+# it is made, and the lookup of their addresses.  These go through the
+# local resolver, so its lifetime bounds the time that they take.
+#
+# The countdown flags are looked up in a compact registry that follows the
+# flagevents journal, rather than in the flag store.  The registry is saved
+# as a snapshot now and then, so a restart need not scan the flag store.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import time
+import syslog
+import threading
+
+import dnslogic
+import cdsscan
+import registry
+import genericapi
+
+from ratelimit import TokenBucket
+
+
+# Start warming up this many seconds before a deadline passes; this should
+# be less than dnslogic.probe_lifetime
+lead = 30
+
+# The number of seconds between scans of the flag store
+interval = 10
+
+# The budget of queries per second, and the burst size
+budget = (20, 100)
+
+# The snapshot of the registry, and the number of seconds between saves
+snapshot = genericapi.flagdir + '.registry'
+snapshot_interval = 600
+
+
+#
+# The checks that a poll will do after each countdown has ended
+#
+def warm_ds (zone):
+	dnslogic.have_ds (zone)
+
+warmers = { }
+warmers ['signed'   ] = warm_ds
+warmers ['chained'  ] = warm_ds
+warmers ['unchained'] = warm_ds
+
+# The number of queries that a warmer makes after the parent name servers
+# are known; it looks them up again, and then queries their AAAA and A
+# records and their DS records
+def queries (flagname, zone):
+	try:
+		nss = dnslogic.list_name_servers (zone, dnslogic.PUBLISHER_PARENTS)
+	except Exception:
+		return None
+	if not nss:
+		return None
+	return 1 + 3 * len (nss)
+
+# Wait until the budget admits a number of queries
+def spend (bucket, cost):
+	wait = bucket.take (cost)
+	while wait > 0:
+		time.sleep (wait)
+		wait = bucket.take (cost)
+
+
+#
+# Find the (deadline,flagname,zone) of countdowns that end within the lead
+# time, in order of their deadline
+#
+def upcoming (reg, now):
+	reg.catch_up ()
+	retval = [ ]
+	for flagname in warmers.keys ():
+		for (zone,deadline) in reg.between (flagname, int (now), int (now + lead)):
+			retval.append ( (deadline, flagname, zone) )
+	retval.sort ()
+	return retval
+
+
+def run ():
+	bucket = TokenBucket (*budget)
+	reg = registry.open_registry (snapshot, genericapi.scan_flags)
+	saved = time.time ()
+	warmed = { }
+	while True:
+		now = time.time ()
+		try:
+			soon = upcoming (reg, now)
+		except Exception, e:
+			syslog.syslog (syslog.LOG_ERR, 'Prefetcher failed to read the registry: ' + str (e))
+			soon = [ ]
+		if now - saved >= snapshot_interval:
+			try:
+				reg.save (snapshot)
+			except (IOError, OSError), e:
+				syslog.syslog (syslog.LOG_ERR, 'Failed to save registry snapshot: ' + str (e))
+			saved = now
+		# Forget zones whose deadlines have left the window
+		warmed = dict ([ (key,True) for key in soon if warmed.has_key (key) ])
+		for key in soon:
+			if warmed.has_key (key):
+				continue
+			(deadline,flagname,zone) = key
+			status = reg.get (zone, 'cds')
+			if status and cdsscan.ds_present (status, genericapi.cds_scantime (zone)) is not None:
+				# The poll will use the CDS scan instead
+				continue
+			# The query for the parent name servers
+			spend (bucket, 1)
+			cost = queries (flagname, zone)
+			if not cost:
+				# The poll will find the same trouble
+				warmed [key] = True
+				continue
+			spend (bucket, cost)
+			try:
+				warmers [flagname] (zone)
+			except Exception, e:
+				syslog.syslog (syslog.LOG_INFO, 'Prefetching for ' + zone + ' failed: ' + str (e))
+			warmed [key] = True
+		time.sleep (interval)
+
+
+#
+# Start the prefetcher in a background thread
+#
+def start ():
+	thread = threading.Thread (target=run)
+	thread.daemon = True
+	thread.start ()
+	return thread
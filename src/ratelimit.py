@@ -0,0 +1,67 @@
+# ratelimit.py -- Limit the rate at which a kid may submit zones
+#
+# Each kid with an entry in the rates of the access configuration has a
+# token bucket that fills with the configured number of zones per second,
+# up to its burst size.  A DNSSEC Request is admitted when the bucket holds
+# enough tokens for its zones, and those tokens are then taken.  Requests
+# for more zones than the burst size are admitted when the bucket is full;
+# they leave a debt that must be refilled before the next request is
+# admitted.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import time
+import threading
+
+
+class TokenBucket:
+
+	def __init__ (self, rate, burst):
+		self.rate = float (rate)
+		self.burst = float (burst)
+		self.tokens = self.burst
+		self.stamp = time.time ()
+		self.lock = threading.Lock ()
+
+	#
+	# Take tokens for count zones and return 0, or return the number of
+	# seconds to wait before that would succeed
+	#
+	def take (self, count):
+		self.lock.acquire ()
+		try:
+			now = time.time ()
+			self.tokens = min (self.burst, self.tokens + (now - self.stamp) * self.rate)
+			self.stamp = now
+			need = min (count, self.burst)
+			if self.tokens >= need:
+				self.tokens = self.tokens - count
+				return 0
+			return (need - self.tokens) / self.rate
+		finally:
+			self.lock.release ()
+
+
+buckets = { }
+buckets_lock = threading.Lock ()
+
+#
+# Admit a DNSSEC Request from a kid for count zones under the given rates;
+# return 0 when it may proceed, or else the number of seconds after which
+# to retry.  A bucket is replaced when the rate of its kid is changed.
+#
+def admit (kid, count, rates):
+	if not rates.has_key (kid):
+		return 0
+	(rate,burst) = rates [kid]
+	buckets_lock.acquire ()
+	try:
+		bucket = buckets.get (kid)
+		if bucket is None or (bucket.rate,bucket.burst) != (float (rate),float (burst)):
+			bucket = TokenBucket (rate, burst)
+			buckets [kid] = bucket
+	finally:
+		buckets_lock.release ()
+	return bucket.take (count)
+
@@ -0,0 +1,444 @@
+# registry.py -- Compact in-memory copy of the flag registry
+#
+# Long-running processes that need the lifecycle state of all zones, such
+# as the prefetcher, would spend kilobytes per zone on dictionaries of
+# strings.  The Registry holds the same information in a few arrays that
+# are indexed by a zone id:
+#
+#  * zone names are interned in one byte pool, with an array of offsets;
+#    an open addressing hash table maps names to zone ids
+#  * which flags are present is bit-packed, one 16-bit word per zone
+#  * flags that hold a timestamp or TTL have a column of 32-bit integers,
+#    and an index of the zones with a number in that column, ordered by
+#    that number and then by zone id, so range queries use bisection
+#  * the cds flag has a column with the status
+#  * values that fit none of these, such as the text of the invalid flag,
+#    are kept in a sparse dictionary
+#
+# That is some 50 bytes per zone, plus 8 for each countdown that runs, so
+# a million zones fit in tens of MB.
+#
+# The Registry is kept up to date from the flagevents journal, and it can
+# be saved as a binary snapshot along with the journal offset up to which
+# it is complete, and the identity of the journal.  Loading the snapshot
+# reads the arrays as they are, and then the journal is replayed from the
+# stored offset.  When the journal was rotated in the meantime, the changes
+# after the offset may only be in the old journal, so the flags are scanned
+# anew.  Snapshots use the byte order of the host, and are not meant to be
+# moved between hosts.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import sys
+import zlib
+import bisect
+import struct
+import threading
+from array import array
+
+import json
+
+import flagevents
+import cdsscan
+
+
+# The flags, in the order of their bits
+flagnames = [ 'signing', 'signed', 'chaining', 'chained', 'unchained',
+		'unsigning', 'dsttl', 'dnskeyttl', 'invalid', 'cds' ]
+
+# The flags that hold a timestamp or a TTL, and have a column
+int_flags = [ 'signed', 'chained', 'unchained', 'unsigning', 'dsttl', 'dnskeyttl' ]
+
+# The statuses that the cds flag may hold, and that have a number
+cds_statuses = [ cdsscan.STATUS_MATCH, cdsscan.STATUS_DIFFER,
+		cdsscan.STATUS_DELETE, cdsscan.STATUS_ABSENT,
+		cdsscan.STATUS_PARTIAL, cdsscan.STATUS_UNKNOWN ]
+
+# The largest value that fits in a column
+int_max = 0xffffffff
+
+snapshot_magic = 'ODSRPC-REGISTRY-4 ' + sys.byteorder + '\n'
+
+
+def bit (flagname):
+	return 1 << flagnames.index (flagname)
+
+
+class Registry:
+
+	def __init__ (self, scanner=None):
+		self.lock = threading.RLock ()
+		self.scanner = scanner
+		self.clear ()
+
+	def clear (self):
+		self.offset = 0
+		self.journal_id = (0, 0)
+		self.pool = bytearray ()
+		self.offsets = array ('I', [0])
+		self.slots = array ('i', [-1]) * 1024
+		self.bits = array ('H')
+		self.columns = { }
+		self.index_values = { }
+		self.index_zids = { }
+		for flagname in int_flags:
+			self.columns [flagname] = array ('I')
+			self.index_values [flagname] = array ('I')
+			self.index_zids [flagname] = array ('I')
+		self.cdsstatus = array ('B')
+		self.texts = { }
+		self.deferred = False
+
+	def __len__ (self):
+		return len (self.bits)
+
+	def name (self, zid):
+		return str (self.pool [self.offsets [zid]:self.offsets [zid+1]])
+
+	#
+	# Find the slot for a zone; it holds the zone id, or -1 if absent
+	#
+	def _slot (self, zone):
+		mask = len (self.slots) - 1
+		slot = zlib.crc32 (zone) & mask
+		while True:
+			zid = self.slots [slot]
+			if zid == -1 or self.name (zid) == zone:
+				return slot
+			slot = (slot + 1) & mask
+
+	def _grow (self):
+		self.slots = array ('i', [-1]) * (2 * len (self.slots))
+		for zid in xrange (len (self)):
+			self.slots [self._slot (self.name (zid))] = zid
+
+	#
+	# Return the id of a zone, or None if it is unknown and not created
+	#
+	def zone_id (self, zone, create=False):
+		self.lock.acquire ()
+		try:
+			slot = self._slot (zone)
+			zid = self.slots [slot]
+			if zid != -1:
+				return zid
+			if not create:
+				return None
+			zid = len (self)
+			self.pool.extend (zone)
+			self.offsets.append (len (self.pool))
+			self.bits.append (0)
+			for column in self.columns.values ():
+				column.append (0)
+			self.cdsstatus.append (0)
+			self.slots [slot] = zid
+			if 2 * len (self) > len (self.slots):
+				self._grow ()
+			return zid
+		finally:
+			self.lock.release ()
+
+	#
+	# The position in the index of a flag where (value,zid) is, or would be
+	# inserted to keep it ordered
+	#
+	def _position (self, flagname, value, zid):
+		values = self.index_values [flagname]
+		zids = self.index_zids [flagname]
+		low = bisect.bisect_left (values, value)
+		high = bisect.bisect_right (values, value, low)
+		while low < high:
+			mid = (low + high) // 2
+			if zids [mid] < zid:
+				low = mid + 1
+			else:
+				high = mid
+		return low
+
+	# Whether a zone has a number in the column of an int flag
+	def _indexed (self, zid, flagname):
+		return self.bits [zid] & bit (flagname) and not self.texts.has_key ((zid,flagname))
+
+	def _index (self, zid, flagname, number):
+		if self.deferred:
+			return
+		pos = self._position (flagname, number, zid)
+		self.index_values [flagname].insert (pos, number)
+		self.index_zids [flagname].insert (pos, zid)
+
+	def _unindex (self, zid, flagname):
+		if self.deferred:
+			return
+		pos = self._position (flagname, self.columns [flagname] [zid], zid)
+		del self.index_values [flagname] [pos]
+		del self.index_zids [flagname] [pos]
+
+	#
+	# Build the indexes from the columns, after they were filled
+	#
+	def _reindex (self):
+		for flagname in int_flags:
+			column = self.columns [flagname]
+			order = sorted ([ (column [zid], zid) for zid in xrange (len (self))
+					if self._indexed (zid, flagname) ])
+			self.index_values [flagname] = array ('I', [ value for (value,zid) in order ])
+			self.index_zids [flagname] = array ('I', [ zid for (value,zid) in order ])
+
+	#
+	# Set a flag to a value as read from its flag file, so False for
+	# absent, True for empty and otherwise a string
+	#
+	def set (self, zone, flagname, value):
+		if not flagname in flagnames:
+			return
+		# Strings in the flagevents journal are unicode
+		zone = str (zone)
+		if type (value) == unicode:
+			value = str (value)
+		self.lock.acquire ()
+		try:
+			zid = self.zone_id (zone, create=value is not False)
+			if zid is None:
+				return
+			if flagname in int_flags and self._indexed (zid, flagname):
+				self._unindex (zid, flagname)
+			if self.texts.has_key ((zid,flagname)):
+				del self.texts [(zid,flagname)]
+			if value is False:
+				self.bits [zid] = self.bits [zid] & ~bit (flagname)
+				return
+			self.bits [zid] = self.bits [zid] | bit (flagname)
+			if value is True:
+				if flagname in int_flags or flagname == 'cds':
+					self.texts [(zid,flagname)] = value
+				return
+			if flagname in int_flags:
+				try:
+					number = int (value)
+					if str (number) == value and 0 <= number <= int_max:
+						self.columns [flagname] [zid] = number
+						self._index (zid, flagname, number)
+						return
+				except ValueError:
+					pass
+			elif flagname == 'cds':
+				if value in cds_statuses:
+					self.cdsstatus [zid] = cds_statuses.index (value)
+					return
+			elif value == '':
+				return
+			self.texts [(zid,flagname)] = value
+		finally:
+			self.lock.release ()
+
+	def get (self, zone, flagname):
+		self.lock.acquire ()
+		try:
+			zid = self.zone_id (zone)
+			if zid is None:
+				return False
+			return self._get (zid, flagname)
+		finally:
+			self.lock.release ()
+
+	def _get (self, zid, flagname):
+		if not self.bits [zid] & bit (flagname):
+			return False
+		text = self.texts.get ((zid,flagname))
+		if text is not None:
+			return text
+		if flagname in int_flags:
+			return str (self.columns [flagname] [zid])
+		if flagname == 'cds':
+			return cds_statuses [self.cdsstatus [zid]]
+		return True
+
+	#
+	# The flags of a zone as a dictionary, as genericapi.scan_flags() has it
+	#
+	def flags (self, zone):
+		self.lock.acquire ()
+		try:
+			zid = self.zone_id (zone)
+			if zid is None:
+				return { }
+			return self._flags (zid)
+		finally:
+			self.lock.release ()
+
+	def _flags (self, zid):
+		retval = { }
+		if self.bits [zid] != 0:
+			for flagname in flagnames:
+				value = self._get (zid, flagname)
+				if value is not False:
+					retval [flagname] = value
+		return retval
+
+	#
+	# Produce (zone,flags) for the zones with any flags, in order of zone id
+	#
+	def scan (self):
+		for zid in xrange (len (self)):
+			self.lock.acquire ()
+			try:
+				if self.bits [zid] == 0:
+					continue
+				item = (self.name (zid), self._flags (zid))
+			finally:
+				self.lock.release ()
+			yield item
+
+	#
+	# Return (zone,value) for the zones whose int flag has a number in the
+	# range [low,high), in order of that number, from the index of the flag
+	#
+	def between (self, flagname, low, high):
+		self.lock.acquire ()
+		try:
+			values = self.index_values [flagname]
+			zids = self.index_zids [flagname]
+			first = bisect.bisect_left (values, low)
+			last = bisect.bisect_left (values, high, first)
+			return [ (self.name (zids [pos]), values [pos])
+					for pos in xrange (first, last) ]
+		finally:
+			self.lock.release ()
+
+	#
+	# Fill the registry from (zone,flags) tuples, as produced by
+	# genericapi.scan_flags()
+	#
+	def fill (self, scan):
+		# Inserting into the indexes one by one would take quadratic time
+		self.lock.acquire ()
+		try:
+			self.deferred = True
+			try:
+				for (zone,flags) in scan:
+					for (flagname,value) in flags.items ():
+						self.set (zone, flagname, value)
+			finally:
+				self.deferred = False
+				self._reindex ()
+		finally:
+			self.lock.release ()
+
+	#
+	# Fill the Registry from a scan of the flag store, after which the
+	# journal is followed from its current end
+	#
+	def rescan (self):
+		self.lock.acquire ()
+		try:
+			self.clear ()
+			# Changes during the scan are replayed from the journal
+			self.journal_id = flagevents.identity ()
+			try:
+				self.offset = os.stat (flagevents.journal).st_size
+			except OSError:
+				self.offset = 0
+			self.fill (self.scanner ())
+		finally:
+			self.lock.release ()
+
+	#
+	# Apply the changes in the flagevents journal since the last time.  When
+	# the journal was rotated, scan the flags again if a scanner was given,
+	# or else read the new journal from its beginning.
+	#
+	def catch_up (self):
+		self.lock.acquire ()
+		try:
+			ident = flagevents.identity ()
+			if not flagevents.same_journal (self.journal_id, ident):
+				if self.scanner is not None:
+					self.rescan ()
+				else:
+					self.offset = 0
+			elif ident [0] != 0:
+				self.journal_id = ident
+			for (offset,event) in flagevents.follow (self.offset):
+				self.set (event ['zone'], event ['flag'], event ['new'])
+				self.offset = offset
+		finally:
+			self.lock.release ()
+
+	#
+	# Save a snapshot, through a temporary file that is renamed into place
+	#
+	def save (self, path):
+		temp = path + '.tmp.' + str (os.getpid ())
+		fh = open (temp, 'wb')
+		try:
+			self.lock.acquire ()
+			try:
+				fh.write (snapshot_magic)
+				fh.write (struct.pack ('=QQI', self.offset, self.journal_id [0], self.journal_id [1]))
+				fh.write (struct.pack ('=I', len (self.pool)))
+				fh.write (self.pool)
+				for arr in self._arrays ():
+					fh.write (struct.pack ('=I', len (arr)))
+					arr.tofile (fh)
+				texts = json.dumps ([ [zid, flagname, value]
+						for ((zid,flagname),value) in self.texts.items () ])
+				fh.write (struct.pack ('=I', len (texts)))
+				fh.write (texts)
+			finally:
+				self.lock.release ()
+			fh.flush ()
+			os.fsync (fh.fileno ())
+		finally:
+			fh.close ()
+		os.rename (temp, path)
+
+	#
+	# Load a snapshot; raise IOError or ValueError if it is unusable
+	#
+	def load (self, path):
+		fh = open (path, 'rb')
+		try:
+			if fh.readline () != snapshot_magic:
+				raise ValueError ('Not a registry snapshot for this host: ' + path)
+			(self.offset,ino,first) = struct.unpack ('=QQI', fh.read (20))
+			self.journal_id = (ino, first)
+			(length,) = struct.unpack ('=I', fh.read (4))
+			self.pool = bytearray (fh.read (length))
+			for arr in self._arrays ():
+				del arr [:]
+				(length,) = struct.unpack ('=I', fh.read (4))
+				arr.fromfile (fh, length)
+			(length,) = struct.unpack ('=I', fh.read (4))
+			self.texts = { }
+			for (zid,flagname,value) in json.loads (fh.read (length)):
+				if type (value) == unicode:
+					value = str (value)
+				self.texts [(zid,str (flagname))] = value
+		except (struct.error, EOFError):
+			raise ValueError ('Truncated registry snapshot: ' + path)
+		finally:
+			fh.close ()
+
+	def _arrays (self):
+		retval = [ self.offsets, self.slots, self.bits, self.cdsstatus ]
+		for flagname in int_flags:
+			retval = retval + [ self.columns [flagname],
+					self.index_values [flagname],
+					self.index_zids [flagname] ]
+		return retval
+
+
+#
+# Open a registry from its snapshot, or else from a scan of the flag store,
+# and bring it up to date with the journal
+#
+def open_registry (path, scan):
+	reg = Registry (scan)
+	try:
+		reg.load (path)
+	except (IOError, ValueError):
+		reg.rescan ()
+	reg.catch_up ()
+	return reg
@@ -0,0 +1,61 @@
+# shardmap.py -- Partition zones over ods-rpc worker nodes
+#
+# When there are more zones than one signer and one ods-webapi can handle,
+# they can be spread over several worker nodes, each with its own flag store
+# and signer.  Zones are assigned to nodes by consistent hashing, so adding
+# a node moves only a fair share of the zones to it.  The ods-shardrouter
+# uses this to split bulk DNSSEC Requests by node.
+#
+# Note that zones do not move along with a change to the nodes; their flags
+# and signer setup remain on the old node.  Plan such changes with care.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import bisect
+import hashlib
+
+
+#
+# The worker nodes, each with the host and port of its ods-webapi.  The
+# names are part of the hash, so renaming a node moves its zones.
+#
+nodes = { }
+nodes ['shard0'] = ('localhost', 8001)
+nodes ['shard1'] = ('localhost', 8002)
+nodes ['shard2'] = ('localhost', 8003)
+
+# The number of points per node on the hash ring
+vnodes = 64
+
+
+def hashpoint (text):
+	return int (hashlib.md5 (text).hexdigest () [:16], 16)
+
+
+#
+# The consistent hash ring over the nodes
+#
+class Ring:
+
+	def __init__ (self, nodenames, vnodes=vnodes):
+		self.points = [ ]
+		for node in nodenames:
+			for vn in range (vnodes):
+				self.points.append ( (hashpoint (node + '#' + str (vn)), node) )
+		self.points.sort ()
+		self.keys = [ point for (point,node) in self.points ]
+
+	# The node that is responsible for a zone
+	def lookup (self, zone):
+		zone = zone.lower ().rstrip ('.')
+		i = bisect.bisect (self.keys, hashpoint (zone)) % len (self.keys)
+		return self.points [i] [1]
+
+	# Split a list of zones into a dictionary from node to zones
+	def partition (self, zones):
+		parts = { }
+		for zone in zones:
+			parts.setdefault (self.lookup (zone), [ ]).append (zone)
+		return parts
+
@@ -0,0 +1,61 @@
+# signedapi.py -- Process signed DNSSEC Requests, independently of transport
+#
+# The JOSE signatures make the DNSSEC Requests and Responses independent of
+# the transport that carries them.  This module does the work between the
+# arrival of a signed request and the departure of a signed response, so
+# the front ends for HTTP (ods-webapi) and CoAP (ods-coapapi) only need
+# to move the bytes.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+from math import ceil
+
+from genericapi import run_command, retry_after
+
+import odsjose
+import ratelimit
+import accessconfig
+
+
+# The content type of the signed requests and responses
+content_type = 'application/jose'
+
+# The largest signed request that the front ends accept, in bytes
+max_request = 1 << 20
+
+# The outcomes of serve()
+SERVED    = 'served'
+REFUSED   = 'refused'
+THROTTLED = 'throttled'
+
+
+#
+# Serve a signed DNSSEC Request and return a tuple (outcome,response,retry)
+# where response is the signed DNSSEC Response when the outcome is SERVED,
+# and retry is the number of seconds after which to try again, or None.
+# Requests that fail verification, are not welcome or not understood are
+# REFUSED without saying why.  The request is served under the access
+# configuration that is current when it arrives.
+#
+def serve (content):
+	config = accessconfig.current ()
+	verified = odsjose.verify (content, config.keys)
+	if verified is None:
+		return (REFUSED, None, None)
+	(claims,kid) = verified
+	if not config.allowed (claims.get ('command'), kid):
+		# Refused requests do not spend the tokens of the kid
+		return (REFUSED, None, None)
+	wait = ratelimit.admit (kid, len (claims.get ('zones') or [None]), config.rates)
+	if wait > 0:
+		return (THROTTLED, None, int (ceil (wait)))
+	resp = run_command (claims, kid, config)
+	#DEBUG# print 'RESPONSE =', resp
+	if resp is None:
+		return (REFUSED, None, None)
+	# JWS signing with the requester's kid
+	# Note that this assumes symmetric keys; would need to
+	# configure peer2key mappings for asymmetric keys.
+	response = odsjose.sign (resp, kid, config.keys)   #TODO# SYMMETRIC
+	return (SERVED, response, retry_after (resp))
@@ -0,0 +1,263 @@
+# zonefile.py -- Read the apex records of zone files on local disk
+#
+# Some DNS checks concern only the apex of a zone, and specifically its
+# SOA, NS, DNSKEY and RRSIG records.  When the zone is available in a local
+# file, such as the output of the OpenDNSSEC signer, these can be read from
+# the file instead of being queried from a name server.
+#
+# Files are memory-mapped and parsed line by line, without loading them as a
+# whole.  Only apex records are parsed beyond their owner name.  Files that
+# are known to be in canonical order, such as signer output, have all apex
+# records up front, so parsing stops at the first other owner name.  The
+# outcome is cached until the file's modification time or size changes.
+#
+# The parser handles the master file format as written by the signer and by
+# dig, including $ORIGIN, $TTL, omitted owners, TTLs and classes, comments
+# and parentheses.  Quoted strings are respected while looking for comments
+# and parentheses, but rdata fields are split on whitespace.  An entry that
+# is continued over more than max_entry bytes is refused, so an unbalanced
+# parenthesis cannot pull the rest of a file into memory.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import re
+import mmap
+import threading
+
+
+#
+# The apex records of a zone, as a dictionary from the record type to a
+# list of (ttl,fields) tuples with the rdata fields as strings.
+#
+class Apex:
+
+	def __init__ (self, zone):
+		self.zone = zone
+		self.records = { }
+
+	def add (self, rrtype, ttl, fields):
+		self.records.setdefault (rrtype, [ ]).append ( (ttl, fields) )
+
+	def has (self, rrtype):
+		return len (self.records.get (rrtype, [ ])) > 0
+
+	# The TTL of an RRset, or None if it is absent
+	def ttl (self, rrtype):
+		ttls = [ ttl for (ttl,fields) in self.records.get (rrtype, [ ]) ]
+		if len (ttls) == 0:
+			return None
+		return max (ttls)
+
+	# Whether the RRset is present and covered by an RRSIG
+	def signed (self, rrtype):
+		if not self.has (rrtype):
+			return False
+		for (ttl,fields) in self.records.get ('RRSIG', [ ]):
+			if len (fields) > 0 and fields [0].upper () == rrtype:
+				return True
+		return False
+
+	# The SOA.MINIMUM field, or None if there is no proper SOA
+	def soa_minimum (self):
+		try:
+			return ttl_value (self.records ['SOA'] [0] [1] [6])
+		except (KeyError, IndexError, ValueError):
+			return None
+
+	# The negative caching time as per RFC 2308, or None
+	def negative_caching_ttl (self):
+		soattl = self.ttl ('SOA')
+		soamin = self.soa_minimum ()
+		if soattl is None or soamin is None:
+			return None
+		return min (soattl, soamin)
+
+
+#
+# Parse a TTL in seconds, possibly with BIND-style units like 1h30m
+#
+ttlre = re.compile ('^([0-9]+[wdhms]?)+$', re.IGNORECASE)
+units = { 'w': 604800, 'd': 86400, 'h': 3600, 'm': 60, 's': 1 }
+
+def ttl_value (text):
+	if not ttlre.match (text):
+		raise ValueError ('Not a TTL: ' + text)
+	if text.isdigit ():
+		return int (text)
+	total = 0
+	for (num,unit) in re.findall ('([0-9]+)([wdhms]?)', text.lower ()):
+		total = total + int (num) * units.get (unit, 1)
+	return total
+
+classes = [ 'IN', 'CH', 'HS', 'CS' ]
+
+# The largest number of bytes in an entry that continues over lines
+max_entry = 1 << 16
+
+
+#
+# Remove a comment and the parentheses from a line, outside quoted strings,
+# and return it with the change in the depth of parentheses.  A string that
+# is still open at the end of the line is taken to end there.
+#
+specials = re.compile ('[\\\\"();]')
+
+def scan_line (line):
+	if not specials.search (line):
+		return (line, 0)
+	chars = list (line)
+	depth = 0
+	quoted = False
+	escaped = False
+	for (i,c) in enumerate (chars):
+		if escaped:
+			escaped = False
+		elif c == '\\':
+			escaped = True
+		elif c == '"':
+			quoted = not quoted
+		elif quoted:
+			pass
+		elif c == ';':
+			del chars [i:]
+			break
+		elif c == '(':
+			depth = depth + 1
+			chars [i] = ' '
+		elif c == ')':
+			depth = depth - 1
+			chars [i] = ' '
+	return (''.join (chars), depth)
+
+
+#
+# Produce the lines of a memory-mapped file, joining the ones that are
+# continued within parentheses, and stripping comments
+#
+def entries (mm):
+	pos = 0
+	size = mm.size ()
+	pending = [ ]
+	pending_size = 0
+	depth = 0
+	while pos < size:
+		eol = mm.find ('\n', pos)
+		if eol < 0:
+			eol = size
+		(line,change) = scan_line (mm [pos:eol])
+		pos = eol + 1
+		depth = max (0, depth + change)
+		if depth > 0 or len (pending) > 0:
+			pending.append (line)
+			pending_size = pending_size + len (line) + 1
+			if pending_size > max_entry:
+				raise ValueError ('Entry continues beyond %d bytes at offset %d' % (max_entry, pos))
+			if depth > 0:
+				continue
+			line = ' '.join (pending)
+			pending = [ ]
+			pending_size = 0
+		yield line
+	if len (pending) > 0:
+		yield ' '.join (pending)
+
+
+#
+# Parse the apex records of a zone from a file.  With canonical set, stop
+# at the first owner name that differs from the apex, once the apex was seen.
+#
+def parse (path, zone, canonical):
+	apex = Apex (zone)
+	apexname = zone.lower ().rstrip ('.') + '.'
+	origin = apexname
+	defttl = None
+	owner = None
+	seen = False
+	fh = open (path, 'r')
+	try:
+		if os.fstat (fh.fileno ()).st_size == 0:
+			return apex
+		mm = mmap.mmap (fh.fileno (), 0, access=mmap.ACCESS_READ)
+	finally:
+		fh.close ()
+	try:
+		for line in entries (mm):
+			if line.strip () == '':
+				continue
+			fields = line.split ()
+			if fields [0].upper () == '$ORIGIN' and len (fields) > 1:
+				origin = fields [1].lower ()
+				if origin [-1:] != '.':
+					origin = origin + '.'
+				continue
+			if fields [0].upper () == '$TTL' and len (fields) > 1:
+				defttl = ttl_value (fields [1])
+				continue
+			if fields [0] [:1] == '$':
+				continue
+			if not line [:1].isspace ():
+				owner = fields.pop (0).lower ()
+				if owner == '@':
+					owner = origin
+				elif owner [-1:] != '.':
+					owner = owner + '.' + origin
+			if owner != apexname:
+				if seen and canonical:
+					break
+				continue
+			seen = True
+			ttl = defttl
+			while len (fields) > 0:
+				if ttlre.match (fields [0]) and fields [0] [:1].isdigit ():
+					ttl = ttl_value (fields.pop (0))
+				elif fields [0].upper () in classes:
+					fields.pop (0)
+				else:
+					break
+			if len (fields) == 0:
+				continue
+			rrtype = fields.pop (0).upper ()
+			if ttl is None and rrtype == 'SOA' and len (fields) >= 7:
+				# RFC 2308 fallback when no TTL is given at all
+				ttl = ttl_value (fields [6])
+			apex.add (rrtype, ttl, fields)
+			if rrtype == 'SOA' and defttl is None:
+				defttl = ttl
+	finally:
+		mm.close ()
+	return apex
+
+
+#
+# Return the Apex of a zone in a file, or None if the file cannot be read
+# or parsed.  Results are cached until the file's mtime or size changes.
+#
+cache = { }
+cache_lock = threading.Lock ()
+
+def apex (path, zone, canonical=True):
+	try:
+		st = os.stat (path)
+	except OSError:
+		return None
+	stamp = (st.st_mtime, st.st_size, zone, canonical)
+	cache_lock.acquire ()
+	try:
+		cached = cache.get (path)
+	finally:
+		cache_lock.release ()
+	if cached is not None and cached [0] == stamp:
+		return cached [1]
+	try:
+		parsed = parse (path, zone, canonical)
+	except (IOError, OSError, ValueError, mmap.error):
+		parsed = None
+	cache_lock.acquire ()
+	try:
+		cache [path] = (stamp, parsed)
+	finally:
+		cache_lock.release ()
+	return parsed
+
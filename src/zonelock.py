@@ -0,0 +1,132 @@
+# zonelock.py -- Per-zone locks for the flag registry, across processes
+#
+# The flags of a zone are read, changed and verified in several steps, so
+# processes that work on the same zone at the same time could mix up their
+# flags.  This module locks zones in exclusive or shared mode, across all
+# processes that use the flag registry.
+#
+# Zones are hashed onto a fixed number of stripes, each being one byte of
+# a lock file, which is locked with an fcntl range lock.  Such locks are
+# held by a process, not by a thread, so the threads of a process first
+# take an in-process lock on the stripe; the range lock is taken by the
+# first thread and released by the last.
+#
+# Multiple zones are locked in the sorted order of their stripes, which
+# keeps concurrent requests for many zones from deadlocking.  Zones that
+# share a stripe just share its lock.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import zlib
+import fcntl
+import threading
+
+
+# The lock file, shared by all processes using the flag registry
+lockfile = '/var/opendnssec/rpc.lock'
+
+# The number of stripes that zones are hashed onto
+stripes = 4096
+
+
+def stripe (zone):
+	return (zlib.crc32 (zone) & 0xffffffff) % stripes
+
+
+#
+# The lock file is opened once per process.  It is never closed, because
+# that would release all range locks of the process.
+#
+lockfd = None
+lockfd_lock = threading.Lock ()
+
+def _lockfd ():
+	global lockfd
+	lockfd_lock.acquire ()
+	try:
+		if lockfd is None:
+			lockfd = os.open (lockfile, os.O_RDWR | os.O_CREAT, 0644)
+		return lockfd
+	finally:
+		lockfd_lock.release ()
+
+
+#
+# The in-process lock on a stripe, which takes the range lock for the
+# process while any thread holds it
+#
+class Stripe:
+
+	def __init__ (self, number):
+		self.number = number
+		self.cond = threading.Condition ()
+		self.readers = 0
+		self.writer = False
+
+	def acquire (self, shared):
+		self.cond.acquire ()
+		try:
+			if shared:
+				while self.writer:
+					self.cond.wait ()
+				if self.readers == 0:
+					fcntl.lockf (_lockfd (), fcntl.LOCK_SH, 1, self.number)
+				self.readers = self.readers + 1
+			else:
+				while self.writer or self.readers > 0:
+					self.cond.wait ()
+				fcntl.lockf (_lockfd (), fcntl.LOCK_EX, 1, self.number)
+				self.writer = True
+		finally:
+			self.cond.release ()
+
+	def release (self, shared):
+		self.cond.acquire ()
+		try:
+			if shared:
+				self.readers = self.readers - 1
+				if self.readers > 0:
+					return
+			else:
+				self.writer = False
+			fcntl.lockf (_lockfd (), fcntl.LOCK_UN, 1, self.number)
+			self.cond.notifyAll ()
+		finally:
+			self.cond.release ()
+
+
+table = { }
+table_lock = threading.Lock ()
+
+def _stripe (number):
+	table_lock.acquire ()
+	try:
+		if not table.has_key (number):
+			table [number] = Stripe (number)
+		return table [number]
+	finally:
+		table_lock.release ()
+
+
+#
+# Lock a list of zones and return a handle to release them with
+#
+def acquire (zones, shared=False):
+	numbers = sorted (set ([ stripe (zone) for zone in zones ]))
+	held = [ ]
+	try:
+		for number in numbers:
+			lock = _stripe (number)
+			lock.acquire (shared)
+			held.append (lock)
+	except:
+		release ((shared, held))
+		raise
+	return (shared, held)
+
+def release (handle):
+	(shared,held) = handle
+	for lock in reversed (held):
+		lock.release (shared)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# test_accessconfig.py -- Loading and reloading the access configuration
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import json
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir, 'src'))
+
+# Start without configuration files, so the modules are used
+os.environ ['ODSRPC_CONFDIR'] = tempfile.mktemp ()
+
+import keyconfig
+import commandaccess
+import accessconfig
+
+
+KEY = { 'kid': 'portal@example.com', 'kty': 'oct', 'alg': 'HS256', 'k': 'c2VjcmV0' }
+
+class AccessConfig (unittest.TestCase):
+
+	def setUp (self):
+		self.dir = tempfile.mkdtemp ()
+		self.saved = (accessconfig.keys_file, accessconfig.access_file,
+				accessconfig.snapshot, accessconfig.loaded)
+		accessconfig.keys_file   = self.dir + os.sep + 'keys.json'
+		accessconfig.access_file = self.dir + os.sep + 'access.json'
+
+	def tearDown (self):
+		(accessconfig.keys_file, accessconfig.access_file,
+			accessconfig.snapshot, accessconfig.loaded) = self.saved
+		accessconfig.checked = 0
+		shutil.rmtree (self.dir)
+
+	def write (self, path, value):
+		fh = open (path, 'w')
+		if type (value) == str:
+			fh.write (value)
+		else:
+			json.dump (value, fh)
+		fh.close ()
+
+	def test_modules (self):
+		snapshot = accessconfig.load ()
+		self.assertEqual (snapshot.keys, keyconfig.keys)
+		self.assertEqual (snapshot.rates, commandaccess.rates)
+		self.assertEqual (snapshot.weights, commandaccess.weights)
+
+	def test_files (self):
+		self.write (accessconfig.keys_file, [ KEY ])
+		self.write (accessconfig.access_file, {
+			'acls':    { 'assert_signed': [ 'portal@example.com' ], '*': [ 'admin' ] },
+			'rates':   { 'portal@example.com': [ 10, 100 ] },
+			'weights': { 'portal@example.com': 2 },
+		})
+		snapshot = accessconfig.load ()
+		self.assertEqual (snapshot.keys, { 'portal@example.com': KEY })
+		self.assertEqual (type (snapshot.keys.keys () [0]), str)
+		self.assertEqual (snapshot.rates, { 'portal@example.com': (10, 100) })
+		self.assertEqual (snapshot.weights, { 'portal@example.com': 2 })
+		self.assertTrue (snapshot.allowed ('assert_signed', 'portal@example.com'))
+		self.assertTrue (snapshot.allowed ('assert_signed', 'admin'))
+		self.assertTrue (snapshot.allowed ('sign_start', 'admin'))
+		self.assertFalse (snapshot.allowed ('sign_start', 'portal@example.com'))
+		self.assertFalse (snapshot.allowed ('assert_signed', 'stranger'))
+
+	def test_bad_files (self):
+		self.write (accessconfig.keys_file, [ { 'kty': 'oct' } ])
+		self.assertRaises (ValueError, accessconfig.load)
+		self.write (accessconfig.keys_file, 'not json')
+		self.assertRaises (ValueError, accessconfig.load)
+		os.unlink (accessconfig.keys_file)
+		self.write (accessconfig.access_file, [ ])
+		self.assertRaises (ValueError, accessconfig.load)
+		self.write (accessconfig.access_file, { 'rates': { 'kid': 10 } })
+		self.assertRaises (ValueError, accessconfig.load)
+
+	def test_bad_numbers (self):
+		for value in [ 0, -1, '2', True, None, [ 1 ] ]:
+			self.write (accessconfig.access_file, { 'weights': { 'kid': value } })
+			self.assertRaises (ValueError, accessconfig.load)
+			self.write (accessconfig.access_file, { 'rates': { 'kid': [ value, 10 ] } })
+			self.assertRaises (ValueError, accessconfig.load)
+		self.write (accessconfig.access_file, { 'weights': { 'kid': 0.5 } })
+		self.assertEqual (accessconfig.load ().weights, { 'kid': 0.5 })
+
+	def test_bad_acls (self):
+		for value in [ 'kid', { 'kid': True }, [ 'kid', 7 ], [ [ 'kid' ] ], None ]:
+			self.write (accessconfig.access_file, { 'acls': { 'sign_start': value } })
+			self.assertRaises (ValueError, accessconfig.load)
+		self.write (accessconfig.access_file, { 'acls': { 'sign_start': [ ] } })
+		self.assertFalse (accessconfig.load ().allowed ('sign_start', 'k'))
+
+	def test_lazy (self):
+		# Importing does not load, so tools need not have a usable file
+		self.write (accessconfig.access_file, '{')
+		accessconfig.snapshot = None
+		self.assertRaises (ValueError, accessconfig.current)
+		self.assertRaises (ValueError, accessconfig.start)
+		os.unlink (accessconfig.access_file)
+		snapshot = accessconfig.current ()
+		self.assertTrue (snapshot is not None)
+		accessconfig.start ()
+		self.assertTrue (accessconfig.current () is snapshot)
+
+	def test_reload (self):
+		accessconfig.start ()
+		before = accessconfig.current ()
+		self.write (accessconfig.access_file, { 'acls': { 'sign_start': [ 'newkid' ] } })
+		# Not looked at again until check_interval has passed
+		self.assertTrue (accessconfig.current () is before)
+		accessconfig.checked = 0
+		after = accessconfig.current ()
+		self.assertFalse (after is before)
+		self.assertTrue (after.allowed ('sign_start', 'newkid'))
+		# A broken file leaves the last good Snapshot in place
+		self.write (accessconfig.access_file, '{')
+		accessconfig.checked = 0
+		self.assertTrue (accessconfig.current () is after)
+		self.write (accessconfig.access_file, { 'acls': { 'sign_start': 'newkid' } })
+		accessconfig.checked = 0
+		self.assertTrue (accessconfig.current () is after)
+
+	def test_sighup (self):
+		accessconfig.start ()
+		before = accessconfig.current ()
+		accessconfig.on_sighup (1, None)
+		self.assertFalse (accessconfig.current () is before)
+		self.assertFalse (accessconfig.hangup)
+
+
+if __name__ == '__main__':
+	unittest.main ()
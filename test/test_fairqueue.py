@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# test_fairqueue.py -- The order in which the jobs of kids are taken
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir, 'src'))
+
+import fairqueue
+
+
+class FairQueue (unittest.TestCase):
+
+	def setUp (self):
+		self.queue = fairqueue.FairQueue (workers=1)
+		self.order = [ ]
+		# Hold the worker until all jobs are queued
+		self.gate = threading.Event ()
+		self.queue.submit ('gate', self.gate.wait)
+
+	def job (self, kid, weight=1):
+		return self.queue.submit (kid, lambda: self.order.append (kid), weight)
+
+	def run_all (self, pending):
+		self.gate.set ()
+		for outcome in pending:
+			outcome.wait ()
+
+	def test_results (self):
+		pending = self.queue.submit ('kid', lambda: 42)
+		self.gate.set ()
+		self.assertEqual (pending.wait (), 42)
+
+	def test_errors (self):
+		def fail ():
+			raise KeyError ('example.org')
+		pending = self.queue.submit ('kid', fail)
+		self.gate.set ()
+		self.assertRaises (KeyError, pending.wait)
+		self.assertEqual (self.queue.submit ('kid', lambda: 7).wait (), 7)
+
+	def test_turns (self):
+		pending = [ self.job ('bulk') for i in range (10) ]
+		pending = pending + [ self.job ('small') for i in range (2) ]
+		self.run_all (pending)
+		self.assertEqual (self.order [:4], [ 'bulk', 'small', 'bulk', 'small' ])
+		self.assertEqual (self.order [4:], [ 'bulk' ] * 8)
+
+	def test_weights (self):
+		pending = [ self.job ('heavy', 2) for i in range (6) ]
+		pending = pending + [ self.job ('light', 1) for i in range (3) ]
+		self.run_all (pending)
+		self.assertEqual (self.order, [ 'heavy', 'heavy', 'light' ] * 3)
+
+	def test_idle_credit (self):
+		self.run_all ([ self.job ('early') for i in range (5) ])
+		self.order = [ ]
+		self.gate.clear ()
+		self.queue.submit ('gate', self.gate.wait)
+		pending = [ self.job ('late') for i in range (3) ]
+		pending = pending + [ self.job ('early') for i in range (3) ]
+		self.run_all (pending)
+		self.assertEqual (self.order, [ 'late', 'early' ] * 3)
+
+
+if __name__ == '__main__':
+	unittest.main ()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# test_flagwal.py -- Group commit of flag transitions
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir, 'src'))
+
+# genericapi wants its flag directory when it is imported
+flagroot = tempfile.mkdtemp ()
+os.environ ['ODSRPC_FLAGDIR'] = flagroot + os.sep + 'rpc'
+os.mkdir (flagroot + os.sep + 'rpc')
+
+import flagwal
+import flagevents
+import accessconfig
+import genericapi
+
+
+class GroupCommit (unittest.TestCase):
+
+	def setUp (self):
+		self.dir = tempfile.mkdtemp ()
+		self.saved = (flagwal.walfile, os.fsync)
+		flagwal.walfile = self.dir + os.sep + 'rpc.wal'
+		self.syncs = [ ]
+		def fsync (fd):
+			# Slow enough for other Groups to queue up
+			self.syncs.append (fd)
+			time.sleep (0.05)
+		os.fsync = fsync
+		self.applied = [ ]
+
+	def tearDown (self):
+		(flagwal.walfile, os.fsync) = self.saved
+		shutil.rmtree (self.dir)
+
+	def apply (self, zone, flagname, value):
+		self.applied.append ( (zone, flagname, value) )
+
+	def group (self, zone):
+		group = flagwal.Group ()
+		group.intend (zone, 'signing', True)
+		group.intend (zone, 'signed', '100')
+		return group
+
+	def test_commit (self):
+		flagwal.commit (self.group ('example.org'), self.apply)
+		self.assertEqual (self.applied, [ ('example.org', 'signing', True), ('example.org', 'signed', '100') ])
+		self.assertEqual (len (self.syncs), 1)
+
+	def test_empty (self):
+		called = [ ]
+		flagwal.submit (flagwal.Group (), self.apply, lambda: called.append (True)).wait ()
+		self.assertEqual (called, [ True ])
+		self.assertEqual (self.syncs, [ ])
+
+	def test_shared_fsync (self):
+		pending = [ flagwal.submit (self.group ('zone%d.example' % i), self.apply)
+				for i in range (50) ]
+		for committed in pending:
+			committed.wait ()
+		self.assertEqual (len (self.applied), 100)
+		self.assertTrue (len (self.syncs) <= 2)
+
+	def test_failure (self):
+		def apply (zone, flagname, value):
+			if zone == 'bad.example':
+				raise IOError ('No space left')
+			self.apply (zone, flagname, value)
+		called = [ ]
+		bad = flagwal.submit (self.group ('bad.example'), apply, lambda: called.append ('bad'))
+		good = flagwal.submit (self.group ('good.example'), apply, lambda: called.append ('good'))
+		self.assertRaises (IOError, bad.wait)
+		good.wait ()
+		self.assertEqual (sorted (called), [ 'bad', 'good' ])
+		self.assertEqual (len (self.applied), 2)
+
+	def test_recover (self):
+		flagwal.commit (self.group ('example.org'), self.apply)
+		self.applied = [ ]
+		flagwal.recover (self.apply)
+		self.assertEqual (self.applied, [ ])
+		self.assertEqual (os.stat (flagwal.walfile).st_size, 0)
+
+
+class Request (unittest.TestCase):
+
+	def setUp (self):
+		self.saved = (os.fsync, flagevents.journal)
+		flagevents.journal = flagroot + os.sep + 'rpc.events'
+		self.syncs = [ ]
+		def fsync (fd):
+			self.syncs.append (fd)
+			time.sleep (0.05)
+		os.fsync = fsync
+		def handler (zone, kid):
+			genericapi.flagged_signing (zone, value=True)
+			genericapi.flagged_dsttl (zone, value='3600')
+			return genericapi.RES_OK
+		genericapi.handler ['test_flags'] = handler
+		genericapi.costclass ['test_flags'] = genericapi.COST_BACKEND
+		self.config = accessconfig.Snapshot ({ }, { 'test_flags': [ 'kid' ] }, { }, { })
+
+	def tearDown (self):
+		(os.fsync, flagevents.journal) = self.saved
+		del genericapi.handler ['test_flags']
+		del genericapi.costclass ['test_flags']
+
+	def test_bulk_request (self):
+		zones = [ 'zone%d.example' % i for i in range (200) ]
+		retval = genericapi.run_command ({ 'command': 'test_flags', 'zones': zones }, 'kid', self.config)
+		self.assertEqual (sorted (retval [genericapi.RES_OK]), sorted (zones))
+		for zone in zones:
+			self.assertEqual (genericapi.flagged_dsttl (zone), '3600')
+		# One backend worker takes the zones one by one, yet they share
+		# the fsync() calls of the write-ahead journal
+		self.assertTrue (len (self.syncs) <= 10, 'Used %d fsync() calls' % len (self.syncs))
+
+
+def tearDownModule ():
+	shutil.rmtree (flagroot)
+
+
+if __name__ == '__main__':
+	unittest.main ()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# test_ingest.py -- Apply IXFR and AXFR replies to input files
+#
+# The transfers are synthetic streams of (text,key,serial) tuples, as made
+# by ingest.records(), so no primary name server is involved.
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir, 'src'))
+
+import backend
+import ingest
+
+
+ZONE = 'example.org'
+
+def soa (serial, ttl=3600):
+	return rr ('example.org.', ttl, 'SOA', 'ns.example.org. hostmaster.example.org. %d 7200 3600 1209600 3600' % serial, serial)
+
+def rr (owner, ttl, rrtype, rdata, serial=None):
+	text = '%s\t%d\tIN\t%s\t%s\n' % (owner, ttl, rrtype, rdata)
+	return (text, ingest.key (text), serial)
+
+NS  = rr ('example.org.',     3600, 'NS', 'ns.example.org.')
+WWW = rr ('www.example.org.', 3600, 'A',  '192.0.2.1')
+FTP = rr ('ftp.example.org.', 3600, 'A',  '192.0.2.2')
+MX  = rr ('example.org.',     3600, 'MX', '10 mail.example.org.')
+
+
+class Transfers (unittest.TestCase):
+
+	def setUp (self):
+		self.dir = tempfile.mkdtemp ()
+		self.saved = (backend.zone_input_dir, ingest.records, ingest.dns.query.xfr)
+		backend.zone_input_dir = self.dir
+		self.requests = [ ]
+		def xfr (*args, **kwargs):
+			self.requests.append (kwargs)
+			return None
+		ingest.dns.query.xfr = xfr
+
+	def tearDown (self):
+		(backend.zone_input_dir, ingest.records, ingest.dns.query.xfr) = self.saved
+		shutil.rmtree (self.dir)
+
+	def install (self, serial, records):
+		fh = open (ingest.input_file (ZONE), 'w')
+		fh.write (soa (serial) [0])
+		for rec in records:
+			fh.write (rec [0])
+		fh.close ()
+
+	def reply (self, stream):
+		ingest.records = lambda messages: iter (stream)
+
+	def lines (self):
+		return open (ingest.input_file (ZONE)).readlines ()
+
+	def leftovers (self):
+		return [ fn for fn in os.listdir (self.dir) if '.tmp.' in fn ]
+
+	def test_axfr (self):
+		self.reply ([ soa (1), NS, WWW, soa (1) ])
+		self.assertEqual (ingest.transfer (ZONE), 1)
+		self.assertEqual (self.requests [0] ['rdtype'], ingest.rdatatype.AXFR)
+		self.assertEqual (self.lines (), [ soa (1) [0], NS [0], WWW [0] ])
+
+	def test_up_to_date (self):
+		self.install (5, [ NS, WWW ])
+		before = self.lines ()
+		self.reply ([ soa (5) ])
+		self.assertEqual (ingest.transfer (ZONE), 5)
+		self.assertEqual (self.requests [0] ['serial'], 5)
+		self.assertEqual (self.lines (), before)
+
+	def test_multiple_differences (self):
+		self.install (1, [ NS, WWW ])
+		self.reply ([ soa (3),
+			soa (1), WWW, soa (2), FTP,
+			soa (2), soa (3), MX,
+			soa (3) ])
+		self.assertEqual (ingest.transfer (ZONE), 3)
+		self.assertEqual (self.lines (), [ soa (3) [0], NS [0], FTP [0], MX [0] ])
+		self.assertEqual (self.leftovers (), [ ])
+
+	def test_delete_and_add_again (self):
+		self.install (1, [ NS, WWW ])
+		self.reply ([ soa (3),
+			soa (1), WWW, soa (2),
+			soa (2), soa (3), WWW,
+			soa (3) ])
+		ingest.transfer (ZONE)
+		self.assertEqual (self.lines (), [ soa (3) [0], NS [0], WWW [0] ])
+
+	def test_add_and_delete_again (self):
+		self.install (1, [ NS ])
+		self.reply ([ soa (3),
+			soa (1), soa (2), FTP,
+			soa (2), FTP, soa (3),
+			soa (3) ])
+		ingest.transfer (ZONE)
+		self.assertEqual (self.lines (), [ soa (3) [0], NS [0] ])
+
+	def test_ttl_change (self):
+		self.install (1, [ NS, WWW ])
+		longer = rr ('www.example.org.', 86400, 'A', '192.0.2.1')
+		self.assertEqual (longer [1], WWW [1])
+		self.reply ([ soa (2),
+			soa (1), WWW, soa (2), longer,
+			soa (2) ])
+		ingest.transfer (ZONE)
+		self.assertEqual (self.lines (), [ soa (2) [0], NS [0], longer [0] ])
+
+	def test_axfr_style_reply (self):
+		self.install (1, [ NS, WWW ])
+		self.reply ([ soa (4), NS, MX, soa (4) ])
+		self.assertEqual (ingest.transfer (ZONE), 4)
+		self.assertEqual (self.requests [0] ['rdtype'], ingest.rdatatype.IXFR)
+		self.assertEqual (self.lines (), [ soa (4) [0], NS [0], MX [0] ])
+
+	def test_serial (self):
+		self.assertEqual (ingest.current_serial (ZONE), None)
+		self.install (7, [ NS ])
+		self.assertEqual (ingest.current_serial (ZONE), 7)
+		# A file that does not start with the SOA is transferred in full
+		fh = open (ingest.input_file (ZONE), 'w')
+		fh.write (NS [0] + soa (7) [0])
+		fh.close ()
+		self.assertEqual (ingest.current_serial (ZONE), None)
+
+	def test_installed_serial (self):
+		# The IXFR starts from the serial of the file that is in place,
+		# even if an older transfer left a serial file behind
+		self.install (3, [ NS, FTP ])
+		open (ingest.input_file (ZONE) + '.serial', 'w').write ('1\n')
+		self.reply ([ soa (3) ])
+		self.assertEqual (ingest.transfer (ZONE), 3)
+		self.assertEqual (self.requests [0] ['serial'], 3)
+
+	def test_fallback (self):
+		self.install (1, [ NS, WWW ])
+		replies = [ [ soa (2), soa (1), WWW, soa (2), FTP ], [ soa (2), NS, FTP, soa (2) ] ]
+		ingest.records = lambda messages: iter (replies.pop (0))
+		self.assertTrue (ingest.ingest_zone (ZONE))
+		self.assertEqual ([ req ['rdtype'] for req in self.requests ],
+				[ ingest.rdatatype.IXFR, ingest.rdatatype.AXFR ])
+		self.assertEqual (self.lines (), [ soa (2) [0], NS [0], FTP [0] ])
+		self.assertEqual (ingest.current_serial (ZONE), 2)
+
+	def test_incomplete_ixfr (self):
+		self.install (1, [ NS, WWW ])
+		before = self.lines ()
+		self.reply ([ soa (2), soa (1), WWW, soa (2), FTP ])
+		self.assertRaises (ingest.dns.exception.FormError, ingest.transfer, ZONE)
+		self.assertEqual (self.lines (), before)
+		self.assertEqual (self.leftovers (), [ ])
+
+	def test_only_soa (self):
+		self.reply ([ soa (1) ])
+		self.assertRaises (ingest.dns.exception.FormError, ingest.transfer, ZONE)
+		self.assertFalse (os.path.exists (ingest.input_file (ZONE)))
+
+
+class Keys (unittest.TestCase):
+
+	def test_ttl_and_case (self):
+		self.assertEqual (ingest.key ('WWW.Example.ORG.\t60\tin\ta\t192.0.2.1\n'),
+				ingest.key ('www.example.org.  3600  IN  A  192.0.2.1\n'))
+
+	def test_short_line (self):
+		self.assertEqual (ingest.key ('; comment\n'), None)
+
+
+if __name__ == '__main__':
+	unittest.main ()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# test_memo.py -- Remembered results and what makes them forgotten
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+import json
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir, 'src'))
+
+import flagevents
+import memo
+
+
+ZONE = 'example.org'
+
+class Memo (unittest.TestCase):
+
+	def setUp (self):
+		self.dir = tempfile.mkdtemp ()
+		self.saved = (flagevents.journal, memo.flagdir, memo.floor, memo.prune_size)
+		flagevents.journal = self.dir + os.sep + 'rpc.events'
+		memo.flagdir = self.dir
+		memo.entries = { }
+		memo.offset = None
+
+	def tearDown (self):
+		(flagevents.journal, memo.flagdir, memo.floor, memo.prune_size) = self.saved
+		shutil.rmtree (self.dir)
+
+	def flag (self, flagname, value):
+		fh = open (self.dir + os.sep + ZONE + os.extsep + flagname, 'w')
+		fh.write (value)
+		fh.close ()
+
+	def journal (self, pid):
+		fh = open (flagevents.journal, 'a')
+		fh.write (json.dumps ({ 'zone': ZONE, 'flag': 'signing',
+				'old': False, 'new': True,
+				'time': time.time (), 'pid': pid }) + '\n')
+		fh.close ()
+
+	def test_floor (self):
+		memo.store (ZONE, 'assert_chained', 'ok', None)
+		self.assertEqual (memo.lookup (ZONE, 'assert_chained'), ('ok', None))
+		memo.floor = 0
+		memo.store (ZONE, 'assert_chained', 'ok', None)
+		self.assertEqual (memo.lookup (ZONE, 'assert_chained'), None)
+		self.assertEqual (memo.entries, { })
+
+	def test_deadline (self):
+		memo.floor = 0
+		deadline = int (time.time ()) + 3600
+		self.flag ('signed', str (deadline))
+		memo.store (ZONE, 'assert_signed', 'error', deadline, deadline)
+		self.assertEqual (memo.lookup (ZONE, 'assert_signed'), ('error', deadline))
+
+	def test_other_commands (self):
+		memo.store (ZONE, 'sign_start', 'ok', None)
+		self.assertEqual (memo.lookup (ZONE, 'sign_start'), None)
+		self.assertEqual (memo.entries, { })
+
+	def test_external_write (self):
+		deadline = int (time.time ()) + 3600
+		self.flag ('signed', str (deadline))
+		memo.store (ZONE, 'assert_signed', 'error', deadline, deadline)
+		# As done by contrib/fast-forward-timers, without a journal event
+		os.unlink (self.dir + os.sep + ZONE + os.extsep + 'signed')
+		self.flag ('signed', str (deadline - 3000))
+		self.assertEqual (memo.lookup (ZONE, 'assert_signed'), None)
+
+	def test_forget (self):
+		memo.store (ZONE, 'assert_chained', 'ok', None)
+		memo.store (ZONE, 'assert_signed', 'ok', None)
+		memo.store ('example.com', 'assert_signed', 'ok', None)
+		memo.forget (ZONE)
+		self.assertEqual (memo.lookup (ZONE, 'assert_chained'), None)
+		self.assertEqual (memo.lookup (ZONE, 'assert_signed'), None)
+		self.assertEqual (memo.lookup ('example.com', 'assert_signed'), ('ok', None))
+
+	def test_journal (self):
+		self.journal (os.getpid ())
+		memo.catch_up ()
+		memo.store (ZONE, 'assert_chained', 'ok', None)
+		# Our own changes are reported through forget()
+		self.journal (os.getpid ())
+		self.assertEqual (memo.lookup (ZONE, 'assert_chained'), ('ok', None))
+		# Those of other processes come from the journal
+		self.journal (os.getpid () + 1)
+		self.assertEqual (memo.lookup (ZONE, 'assert_chained'), None)
+
+	def test_prune (self):
+		memo.prune_size = 3
+		for zone in [ 'a.example', 'b.example', 'c.example' ]:
+			memo.store (zone, 'assert_chained', 'ok', None)
+		memo.entries [('a.example','assert_chained')] = ('ok', None, 0, None)
+		memo.store ('d.example', 'assert_chained', 'ok', None)
+		self.assertEqual (sorted ([ zone for (zone,command) in memo.entries.keys () ]),
+				[ 'b.example', 'c.example', 'd.example' ])
+
+
+if __name__ == '__main__':
+	unittest.main ()
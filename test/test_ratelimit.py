@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# test_ratelimit.py -- Token buckets per kid
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir, 'src'))
+
+import ratelimit
+
+
+#
+# A clock that only moves when told to
+#
+class Clock:
+
+	def __init__ (self):
+		self.now = 1000000.0
+
+	def time (self):
+		return self.now
+
+
+class RateLimit (unittest.TestCase):
+
+	def setUp (self):
+		self.saved = ratelimit.time
+		self.clock = Clock ()
+		ratelimit.time = self.clock
+		ratelimit.buckets = { }
+
+	def tearDown (self):
+		ratelimit.time = self.saved
+
+	def test_burst (self):
+		bucket = ratelimit.TokenBucket (2, 10)
+		self.assertEqual (bucket.take (6), 0)
+		self.assertEqual (bucket.take (4), 0)
+		self.assertEqual (bucket.take (1), 0.5)
+		self.clock.now += 0.5
+		self.assertEqual (bucket.take (1), 0)
+
+	def test_refill_limit (self):
+		bucket = ratelimit.TokenBucket (2, 10)
+		self.clock.now += 3600
+		self.assertEqual (bucket.take (10), 0)
+		self.assertEqual (bucket.take (1), 0.5)
+
+	def test_debt (self):
+		bucket = ratelimit.TokenBucket (2, 10)
+		# More than the burst is admitted from a full bucket
+		self.assertEqual (bucket.take (30), 0)
+		self.assertEqual (bucket.take (1), 10.5)
+		self.clock.now += 5
+		self.assertEqual (bucket.take (20), 10.0)
+		self.clock.now += 10
+		self.assertEqual (bucket.take (20), 0)
+
+	def test_unlimited (self):
+		self.assertEqual (ratelimit.admit ('kid', 1000000, { }), 0)
+		self.assertEqual (ratelimit.buckets, { })
+
+	def test_admit (self):
+		rates = { 'kid': (1, 5) }
+		self.assertEqual (ratelimit.admit ('kid', 5, rates), 0)
+		self.assertEqual (ratelimit.admit ('kid', 2, rates), 2.0)
+		self.assertEqual (ratelimit.admit ('other', 2, rates), 0)
+
+	def test_rate_change (self):
+		self.assertEqual (ratelimit.admit ('kid', 5, { 'kid': (1, 5) }), 0)
+		self.assertEqual (ratelimit.admit ('kid', 5, { 'kid': (1, 5) }), 5.0)
+		self.assertEqual (ratelimit.admit ('kid', 5, { 'kid': (10, 50) }), 0)
+		self.assertEqual (ratelimit.buckets ['kid'].rate, 10.0)
+
+
+if __name__ == '__main__':
+	unittest.main ()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#
+# test_registry.py -- The compact copy of the flag registry
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+import json
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir, 'src'))
+
+import flagevents
+import registry
+
+
+class Registry (unittest.TestCase):
+
+	def setUp (self):
+		self.dir = tempfile.mkdtemp ()
+		self.saved = flagevents.journal
+		flagevents.journal = self.dir + os.sep + 'rpc.events'
+		self.reg = registry.Registry ()
+
+	def tearDown (self):
+		flagevents.journal = self.saved
+		shutil.rmtree (self.dir)
+
+	def journal (self, zone, flagname, new):
+		fh = open (flagevents.journal, 'a')
+		fh.write (json.dumps ({ 'zone': zone, 'flag': flagname,
+				'old': None, 'new': new,
+				'time': time.time (), 'pid': 1 }) + '\n')
+		fh.close ()
+
+	def test_values (self):
+		reg = self.reg
+		reg.set ('example.org', 'signing', True)
+		reg.set ('example.org', 'signed', '1700000000')
+		reg.set ('example.org', 'dsttl', True)
+		reg.set ('example.org', 'chained', '-5')
+		reg.set ('example.org', 'invalid', 'No SOA')
+		reg.set ('example.org', 'cds', 'match')
+		self.assertEqual (reg.flags ('example.org'), {
+			'signing': True,
+			'signed':  '1700000000',
+			'dsttl':   True,
+			'chained': '-5',
+			'invalid': 'No SOA',
+			'cds':     'match',
+		})
+		self.assertEqual (reg.texts, {
+			(0,'dsttl'):   True,
+			(0,'chained'): '-5',
+			(0,'invalid'): 'No SOA',
+		})
+		reg.set ('example.org', 'chained', '1700000100')
+		self.assertEqual (reg.get ('example.org', 'chained'), '1700000100')
+		self.assertFalse (reg.texts.has_key ((0,'chained')))
+		reg.set ('example.org', 'signed', False)
+		self.assertEqual (reg.get ('example.org', 'signed'), False)
+		self.assertEqual (reg.get ('example.com', 'signed'), False)
+		self.assertEqual (reg.flags ('example.com'), { })
+
+	def test_unknown_flag (self):
+		self.reg.set ('example.org', 'bogus', True)
+		self.assertEqual (len (self.reg), 0)
+
+	def test_absent_zone (self):
+		self.reg.set ('example.org', 'signing', False)
+		self.assertEqual (self.reg.zone_id ('example.org'), None)
+
+	def test_many_zones (self):
+		zones = [ 'zone%d.example' % i for i in range (5000) ]
+		for zone in zones:
+			self.reg.set (zone, 'signing', True)
+		self.assertEqual (len (self.reg), len (zones))
+		self.assertTrue (len (self.reg.slots) >= 2 * len (zones))
+		for (zid,zone) in enumerate (zones):
+			self.assertEqual (self.reg.zone_id (zone), zid)
+			self.assertEqual (self.reg.name (zid), zone)
+		self.assertEqual (len (list (self.reg.scan ())), len (zones))
+
+	def test_scan (self):
+		self.reg.set ('a.example', 'signing', True)
+		self.reg.set ('b.example', 'signing', True)
+		self.reg.set ('a.example', 'signing', False)
+		self.assertEqual (list (self.reg.scan ()), [ ('b.example', { 'signing': True }) ])
+
+	def test_between (self):
+		reg = self.reg
+		reg.set ('a.example', 'signed', '100')
+		reg.set ('b.example', 'signed', '200')
+		reg.set ('c.example', 'signed', '300')
+		reg.set ('d.example', 'chained', '150')
+		reg.set ('e.example', 'signed', True)
+		self.assertEqual (sorted (reg.between ('signed', 100, 300)),
+				[ ('a.example', 100), ('b.example', 200) ])
+		self.assertEqual (list (reg.between ('chained', 0, 1000)), [ ('d.example', 150) ])
+		reg.set ('a.example', 'signed', '250')
+		reg.set ('b.example', 'signed', False)
+		self.assertEqual (sorted (reg.between ('signed', 0, 1000)),
+				[ ('a.example', 250), ('c.example', 300) ])
+		self.assertEqual (list (reg.between ('signed', 301, 1000)), [ ])
+
+	def test_fill (self):
+		flags = [ ('zone%d.example' % i, { 'signed': str ((i * 7919) % 1000) })
+				for i in range (3000) ]
+		filled = registry.Registry ()
+		filled.fill (flags)
+		for (zone,values) in flags:
+			self.reg.set (zone, 'signed', values ['signed'])
+		self.assertEqual (filled.between ('signed', 0, 1000), self.reg.between ('signed', 0, 1000))
+		filled.set ('zone0.example', 'signed', '2000')
+		self.assertEqual (filled.between ('signed', 1000, 3000), [ ('zone0.example', 2000) ])
+
+	def test_fill_and_catch_up (self):
+		self.reg.fill ([ ('a.example', { 'signing': True, 'signed': '100' }) ])
+		self.journal ('a.example', 'signed', False)
+		self.journal ('b.example', 'invalid', 'Gone')
+		self.reg.catch_up ()
+		self.assertEqual (self.reg.flags ('a.example'), { 'signing': True })
+		self.assertEqual (self.reg.flags ('b.example'), { 'invalid': 'Gone' })
+		self.assertEqual (self.reg.offset, os.stat (flagevents.journal).st_size)
+
+	def test_snapshot (self):
+		path = self.dir + os.sep + 'rpc.registry'
+		reg = self.reg
+		for i in range (2000):
+			reg.set ('zone%d.example' % i, 'signed', str (1000 + i))
+		reg.set ('zone7.example', 'invalid', 'Broken')
+		reg.set ('zone8.example', 'cds', 'absent')
+		reg.offset = 1234
+		reg.save (path)
+		other = registry.Registry ()
+		other.load (path)
+		self.assertEqual (other.offset, 1234)
+		self.assertEqual (list (other.scan ()), list (reg.scan ()))
+		self.assertEqual (other.zone_id ('zone1999.example'), 1999)
+		self.assertEqual (sorted (other.between ('signed', 1005, 1008)),
+				sorted (reg.between ('signed', 1005, 1008)))
+		other.set ('zone2000.example', 'signing', True)
+		self.assertEqual (other.zone_id ('zone2000.example'), 2000)
+
+	def test_bad_snapshot (self):
+		path = self.dir + os.sep + 'rpc.registry'
+		open (path, 'w').write ('Something else\n')
+		self.assertRaises (ValueError, self.reg.load, path)
+		self.reg.save (path)
+		data = open (path).read ()
+		open (path, 'w').write (data [:len (data) / 2])
+		self.assertRaises (ValueError, registry.Registry ().load, path)
+
+	def test_open_registry (self):
+		path = self.dir + os.sep + 'rpc.registry'
+		self.journal ('a.example', 'signing', True)
+		scan = lambda: iter ([ ('b.example', { 'signed': '100' }) ])
+		reg = registry.open_registry (path, scan)
+		# The journal before the scan is covered by the scan
+		self.assertEqual (reg.flags ('a.example'), { })
+		self.assertEqual (reg.flags ('b.example'), { 'signed': '100' })
+		reg.save (path)
+		self.journal ('c.example', 'signing', True)
+		reg = registry.open_registry (path, None)
+		self.assertEqual (reg.flags ('b.example'), { 'signed': '100' })
+		self.assertEqual (reg.flags ('c.example'), { 'signing': True })
+
+	def test_rotation (self):
+		path = self.dir + os.sep + 'rpc.registry'
+		flags = { 'a.example': { 'signing': True } }
+		scan = lambda: iter (flags.items ())
+		reg = registry.open_registry (path, scan)
+		self.journal ('b.example', 'signing', True)
+		reg.catch_up ()
+		reg.save (path)
+		# A change that only the old journal holds, though the flags have it
+		self.journal ('c.example', 'signing', True)
+		flags ['c.example'] = { 'signing': True }
+		os.rename (flagevents.journal, flagevents.journal + '.1')
+		self.journal ('d.example', 'signing', True)
+		self.journal ('d.example', 'signed', '100')
+		flags ['d.example'] = { 'signing': True, 'signed': '100' }
+		self.assertEqual (registry.open_registry (path, scan).flags ('c.example'), { 'signing': True })
+		reg.catch_up ()
+		self.assertEqual (reg.flags ('c.example'), { 'signing': True })
+		self.assertEqual (reg.flags ('b.example'), { })
+		self.assertEqual (reg.flags ('d.example'), { 'signing': True, 'signed': '100' })
+
+	def test_copytruncate (self):
+		# The journal grows beyond the old offset before it is followed
+		self.journal ('a.example', 'signing', True)
+		self.reg.catch_up ()
+		open (flagevents.journal, 'w').close ()
+		self.journal ('b.example', 'signing', True)
+		self.journal ('c.example', 'signing', True)
+		self.reg.catch_up ()
+		self.assertEqual (self.reg.flags ('b.example'), { 'signing': True })
+		self.assertEqual (self.reg.offset, os.stat (flagevents.journal).st_size)
+
+	def test_empty_journal (self):
+		self.reg.catch_up ()
+		self.assertEqual (self.reg.journal_id, (0, 0))
+		self.journal ('a.example', 'signing', True)
+		self.reg.catch_up ()
+		self.assertEqual (self.reg.journal_id, flagevents.identity ())
+		self.assertEqual (self.reg.flags ('a.example'), { 'signing': True })
+
+
+if __name__ == '__main__':
+	unittest.main ()
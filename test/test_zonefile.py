@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# test_zonefile.py -- Reading apex records from zone files
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir, 'src'))
+
+import zonefile
+
+
+ZONE = '''$ORIGIN example.org.
+$TTL 3600
+@	IN SOA	ns1 hostmaster (
+		2024010101 ; serial
+		7200 3600 1209600 300 )
+	IN TXT	"unbalanced ( inside a string"
+	IN TXT	"semicolon ; and ) inside" "\\"(\\""
+	IN NS	ns1
+	IN NS	ns2.example.net.
+www	IN A	192.0.2.1
+'''
+
+class ZoneFile (unittest.TestCase):
+
+	def setUp (self):
+		self.dir = tempfile.mkdtemp ()
+		self.path = self.dir + os.sep + 'example.org'
+
+	def tearDown (self):
+		shutil.rmtree (self.dir)
+
+	def write (self, text):
+		fh = open (self.path, 'w')
+		fh.write (text)
+		fh.close ()
+
+	def test_apex (self):
+		self.write (ZONE)
+		apex = zonefile.parse (self.path, 'example.org', False)
+		(ttl,soa) = apex.records ['SOA'] [0]
+		self.assertEqual (ttl, 3600)
+		self.assertEqual (soa [:3], [ 'ns1', 'hostmaster', '2024010101' ])
+		self.assertEqual (len (soa), 7)
+		# Parentheses in TXT strings do not swallow the records after them
+		self.assertEqual (len (apex.records ['TXT']), 2)
+		self.assertEqual ([ fields for (ttl,fields) in apex.records ['NS'] ],
+				[ [ 'ns1' ], [ 'ns2.example.net.' ] ])
+
+	def test_canonical (self):
+		self.write (ZONE.replace ('www', 'a') + '@ IN NS ns3\n')
+		apex = zonefile.parse (self.path, 'example.org', True)
+		self.assertEqual (len (apex.records ['NS']), 2)
+
+	def test_unbalanced (self):
+		self.write ('@ IN SOA ns1 hostmaster (\n' + '@ IN NS ns1\n' * 20000)
+		self.assertRaises (ValueError, zonefile.parse, self.path, 'example.org', False)
+		self.assertEqual (zonefile.apex (self.path, 'example.org'), None)
+
+
+if __name__ == '__main__':
+	unittest.main ()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+# test_zonelock.py -- Per-zone locks between threads and processes
+#
+# From: Rick van Rein <rick@openfortress.nl>
+
+
+import os
+import sys
+import select
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir, 'src'))
+
+import zonelock
+
+
+class ZoneLock (unittest.TestCase):
+
+	def setUp (self):
+		self.dir = tempfile.mkdtemp ()
+		zonelock.lockfile = self.dir + os.sep + 'rpc.lock'
+
+	def tearDown (self):
+		# Start the next test on a fresh lock file
+		if zonelock.lockfd is not None:
+			os.close (zonelock.lockfd)
+		zonelock.lockfd = None
+		zonelock.table = { }
+		shutil.rmtree (self.dir)
+
+	# Run a function in a thread, and return whether it completed in time
+	def completes (self, fun, wait=0.2):
+		done = threading.Event ()
+		def run ():
+			fun ()
+			done.set ()
+		thr = threading.Thread (target=run)
+		thr.daemon = True
+		thr.start ()
+		done.wait (wait)
+		return (done.is_set (), done)
+
+	def test_stripes (self):
+		self.assertEqual (zonelock.stripe ('example.org'), zonelock.stripe ('example.org'))
+		for zone in [ 'example.org', 'example.com', 'a.b.example.net' ]:
+			self.assertTrue (0 <= zonelock.stripe (zone) < zonelock.stripes)
+
+	def test_exclusive (self):
+		held = zonelock.acquire ([ 'example.org' ])
+		(finished,done) = self.completes (lambda: zonelock.release (zonelock.acquire ([ 'example.org' ])))
+		self.assertFalse (finished)
+		zonelock.release (held)
+		done.wait (2)
+		self.assertTrue (done.is_set ())
+
+	def test_shared (self):
+		held = zonelock.acquire ([ 'example.org' ], shared=True)
+		(finished,done) = self.completes (lambda: zonelock.release (zonelock.acquire ([ 'example.org' ], shared=True)))
+		self.assertTrue (finished)
+		(finished,done) = self.completes (lambda: zonelock.release (zonelock.acquire ([ 'example.org' ])))
+		self.assertFalse (finished)
+		zonelock.release (held)
+		done.wait (2)
+		self.assertTrue (done.is_set ())
+
+	def test_other_zone (self):
+		zones = [ 'zone%d.example' % i for i in range (100) ]
+		other = [ zone for zone in zones if zonelock.stripe (zone) != zonelock.stripe (zones [0]) ] [0]
+		held = zonelock.acquire ([ zones [0] ])
+		try:
+			(finished,done) = self.completes (lambda: zonelock.release (zonelock.acquire ([ other ])))
+			self.assertTrue (finished)
+		finally:
+			zonelock.release (held)
+
+	def test_many_zones (self):
+		zones = [ 'zone%d.example' % i for i in range (50) ]
+		held = zonelock.acquire (zones + zones)
+		self.assertEqual (len (held [1]), len (set ([ zonelock.stripe (zone) for zone in zones ])))
+		zonelock.release (held)
+		zonelock.release (zonelock.acquire (zones))
+
+	def test_processes (self):
+		held = zonelock.acquire ([ 'example.org' ])
+		(rd,wr) = os.pipe ()
+		pid = os.fork ()
+		if pid == 0:
+			# A fresh process with its own lock file descriptor
+			try:
+				zonelock.lockfd = None
+				zonelock.table = { }
+				zonelock.acquire ([ 'example.org' ])
+				os.write (wr, 'x')
+			finally:
+				os._exit (0)
+		os.close (wr)
+		try:
+			# The child cannot lock the zone while we hold it
+			(ready,_,_) = select.select ([ rd ], [ ], [ ], 0.2)
+			self.assertEqual (ready, [ ])
+		finally:
+			zonelock.release (held)
+		(ready,_,_) = select.select ([ rd ], [ ], [ ], 2)
+		self.assertEqual (ready, [ rd ])
+		self.assertEqual (os.read (rd, 1), 'x')
+		os.waitpid (pid, 0)
+		os.close (rd)
+
+
+if __name__ == '__main__':
+	unittest.main ()